@@ -2,14 +2,11 @@ from __future__ import print_function
 import os.path
 import base64
 import email
-import pandas as pd
-from openai import OpenAI
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
-from google_auth_oauthlib.flow import Flow
+# pandas, openai, html2text and the Google client/auth libraries are imported where they are used so a new
+# container can render the first page without loading them; see `python app.py startup-report`.
+from googleapiclient.errors import HttpError
 from email.mime.text import MIMEText
+from html.parser import HTMLParser
 import base64 as b64
 from datetime import datetime, timedelta
 import pytz
@@ -18,10 +15,21 @@ import streamlit as st
 from streamlit.logger import get_logger
 from urllib.parse import urlparse, parse_qs
 import json
-import html2text
+from decimal import Decimal, InvalidOperation
+import hashlib
+import sqlite3
+import time
+import random
+import math
+import sys
+import bisect
 import uuid
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError as FutureTimeoutError
 logger = get_logger(__name__)
-if 'OPENAI_API_KEY' in st.secrets:
+if os.environ.get('OPENAI_API_KEY'):
+    OPENAI_API_KEY = os.environ['OPENAI_API_KEY']
+elif 'OPENAI_API_KEY' in st.secrets:
     OPENAI_API_KEY = st.secrets['OPENAI_API_KEY']
 else:
     try:
@@ -30,7 +38,72 @@ else:
     except FileNotFoundError:
         st.error("OpenAI API key not found. Please add it to secrets or API.txt file.")
         st.stop()
-client = OpenAI(api_key=OPENAI_API_KEY)
+@st.cache_resource(show_spinner=False)
+def openai_client():
+    from openai import OpenAI
+    # Retries belong to the shared request layer in _create_completion, not the SDK.
+    return OpenAI(api_key=OPENAI_API_KEY, timeout=LLM_REQUEST_TIMEOUT_SECONDS, max_retries=0)
+class LLMError(Exception):
+    """An OpenAI request the retry layer gave up on; state is a key of LLM_FAILURE_LABELS."""
+    def __init__(self, state, message):
+        super().__init__(message)
+        self.state = state
+class LLMRateLimiter:
+    """Token buckets for requests and tokens per minute, plus a concurrency limit that halves on every 429 and
+    grows back by one per window of successes. One instance is shared by all threads and sessions."""
+    def __init__(self, requests_per_minute, tokens_per_minute, max_concurrency):
+        self.capacity = {"requests": requests_per_minute, "tokens": tokens_per_minute}
+        self.available = dict(self.capacity)
+        self.updated_at = time.monotonic()
+        self.max_concurrency = max_concurrency
+        self.concurrency = float(max_concurrency)
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.rate_limited = 0
+        self.condition = threading.Condition()
+    def _refill(self):
+        now = time.monotonic()
+        for bucket, capacity in self.capacity.items():
+            self.available[bucket] = min(capacity, self.available[bucket] + capacity * (now - self.updated_at) / 60)
+        self.updated_at = now
+    def acquire(self, tokens):
+        """Block until a request of about `tokens` tokens may start; returns the tokens reserved."""
+        tokens = min(tokens, self.capacity["tokens"])
+        with self.condition:
+            while True:
+                self._refill()
+                now = time.monotonic()
+                if (now >= self.paused_until and self.in_flight < int(self.concurrency)
+                        and self.available["requests"] >= 1 and self.available["tokens"] >= tokens):
+                    self.available["requests"] -= 1
+                    self.available["tokens"] -= tokens
+                    self.in_flight += 1
+                    return tokens
+                wait = max(self.paused_until - now,
+                           (1 - self.available["requests"]) * 60 / self.capacity["requests"],
+                           (tokens - self.available["tokens"]) * 60 / self.capacity["tokens"], 0.05)
+                self.condition.wait(timeout=min(wait, 1.0))
+    def release(self, reserved, used=None, rate_limited=False, retry_after=None):
+        with self.condition:
+            self.in_flight -= 1
+            if used is not None:
+                self.available["tokens"] = min(self.capacity["tokens"], self.available["tokens"] + reserved - used)
+            if rate_limited:
+                self.rate_limited += 1
+                self.concurrency = max(1.0, self.concurrency / 2)
+                if retry_after:
+                    self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+            else:
+                self.concurrency = min(float(self.max_concurrency), self.concurrency + 1 / self.concurrency)
+            self.condition.notify_all()
+@st.cache_resource(show_spinner=False)
+def llm_rate_limiter():
+    return LLMRateLimiter(LLM_REQUESTS_PER_MINUTE, LLM_TOKENS_PER_MINUTE, LLM_MAX_CONCURRENCY)
+def _retry_after_seconds(error):
+    try:
+        return float(error.response.headers.get("retry-after"))
+    except (AttributeError, TypeError, ValueError):
+        return None
 SCOPES = [
     'https://www.googleapis.com/auth/gmail.modify',
     'https://www.googleapis.com/auth/calendar'
@@ -47,14 +120,227 @@ qa_mapping = {
     "What is the contact phone number mentioned in the email signature?": "contact_number",
     "What is the sender's designation or job title mentioned in the email signature?": "designation"
 }
+business_qa_mapping = {
+    "What is the supplier's location, city, or place mentioned in the email signature?": "place",
+    "What is the sender's personal name mentioned in the email signature?": "sender_name",
+    "What is the company name mentioned in the email signature?": "company_name",
+    "What is the contact phone number mentioned in the email signature?": "contact_number",
+    "What is the sender's designation or job title mentioned in the email signature?": "designation"
+}
+# Ask for every field in one JSON-schema constrained response instead of one request per question.
+STRUCTURED_EXTRACTION = True
+# Fields resolved by the local rule-based extractor at or above this confidence skip the LLM.
+RULE_CONFIDENCE_THRESHOLD = 0.85
+CURRENCY_PATTERN = r'(?:₹|Rs\.?|INR|\$|USD|US\$|€|EUR|£|GBP)'
+AMOUNT_PATTERN = CURRENCY_PATTERN + r'\s?\d[\d,]*(?:\.\d+)?'
+PHONE_LABEL_PATTERN = r'\b(?:ph(?:one)?|mob(?:ile)?|tel(?:ephone)?|cell|contact(?:\s+no\.?)?|whats\s?app|m)\b\.?\s*(?:no\.?\s*)?[:\-]?\s*$'
+QUANTITY_UNITS = r'(?:pcs|pieces?|units?|nos\.?|numbers|items?|boxes|sets?|pairs?|kgs?|meters?|rolls?|cartons?)'
+LEAD_TIME_UNIT_DAYS = {"day": 1, "week": 7, "month": 30}
+CURRENCY_CODES = {"₹": "INR", "rs": "INR", "rs.": "INR", "inr": "INR", "$": "USD", "usd": "USD", "us$": "USD",
+                  "€": "EUR", "eur": "EUR", "£": "GBP", "gbp": "GBP"}
+CURRENCY_DISPLAY = {"INR": "₹", "USD": "$", "EUR": "€", "GBP": "£"}
+QUANTITY_UNIT_NAMES = {"pc": "pcs", "pcs": "pcs", "piece": "pcs", "pieces": "pcs", "nos": "pcs", "nos.": "pcs",
+                       "numbers": "pcs", "unit": "units", "units": "units", "item": "items", "items": "items",
+                       "kg": "kg", "kgs": "kg", "meter": "m", "meters": "m", "box": "boxes", "boxes": "boxes",
+                       "set": "sets", "sets": "sets", "pair": "pairs", "pairs": "pairs", "roll": "rolls",
+                       "rolls": "rolls", "carton": "cartons", "cartons": "cartons"}
+# Local intent classifier trained on stored LLM labels; below the threshold the LLM decides.
+INTENT_MODEL_PATH = "intent_model.json"
+INTENT_LABELS = ["Quotation Received", "Quotation Partially Received", "New Business Connection"]
+LOCAL_CLASSIFIER_THRESHOLD = 0.9
+# Emails sharing fewer distinct features than this with the training data are scored on priors alone.
+MIN_INTENT_KNOWN_FEATURES = 5
+MIN_INTENT_TRAINING_EXAMPLES = 30
+# "fused" asks for classification, meeting details and quotation fields in one request per email;
+# "staged" sends separate meeting, classification and extraction requests.
+ANALYSIS_MODE = "fused"
+CLASSIFICATION_CATEGORIES = """1. "New Business Connection" - If the email is:
+       - Introduction email from new supplier
+       - Company introduction or capability presentation
+       - General business development outreach
+       - Marketing or promotional content
+       - Request for partnership or collaboration
+    2. "Quotation Received" - If the email contains ALL four essential elements:
+       - Product details
+       - Clear pricing information (unit price or total cost)
+       - Specific quantities mentioned
+       - Lead time or delivery information
+    3. "Quotation Partially Received" - If the email contains quotation elements but is missing ANY of these:
+       - Product details OR
+       - Unit price OR
+       - Quantities OR
+       - Lead time"""
+MEETING_GUIDELINES = """1.Determine if the sender intends to set up a meeting. Reply with "Yes" or "No".
+    2. Is a specific date/time mentioned? If yes, convert to ISO 8601 format (IST).
+    3. If yes, infer the proposed date and time, even if partial (e.g., "6th at 4PM", "Monday morning").
+       - Convert into a full datetime string in ISO 8601 format (e.g., "2025-08-06T16:00:00+05:30").
+       - Assume Indian Standard Time (IST).
+       - If the date (e.g., "6th") has already passed this month, infer the next month.
+       - Use the provided current datetime to resolve relative references.
+    4. Who proposed the meeting time? Choose one:
+       - "sender": if the sender suggests a time (e.g., "Let's meet on 8th at 2 PM")
+       - "recipient": if the recipient (you) is asked to suggest a time (e.g., "Please let me know your availability")
+       - "mutual": if both parties are discussing options
+       - "none": if no time or intent"""
+# Local, deterministic resolution of meeting datetimes in IST; the LLM is only asked when this fails.
+MONTH_NUMBERS = {month: number for number, month in enumerate(
+    ["jan", "feb", "mar", "apr", "may", "jun", "jul", "aug", "sep", "oct", "nov", "dec"], 1)}
+WEEKDAY_NUMBERS = {day: number for number, day in enumerate(
+    ["monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday"])}
+TIME_OF_DAY = {"morning": (10, 0), "noon": (12, 0), "afternoon": (14, 0)}
+SCHEDULE_WORDS = r'\b(?:re)?schedule\b|\bbook\b|\bproceed\b|\bset\s+(?:it\s+)?up\b|\bfinali[sz]e\b|\bgo\s+ahead\b|\bfix\b'
+PROPOSE_WORDS = r'\bask\b|\bcheck\b|\bcould\b|\bwould\b|\bsuggest\b|\bpropose\b|\bwhether\b|\bokay\b|\bworks?\s+for\b|\bavailab'
+INSTRUCTION_FILLER = {"the", "meeting", "call", "it", "for", "at", "on", "to", "a", "an", "and", "please", "move", "push",
+                      "shift", "change", "instead", "then", "them", "him", "her", "with", "of", "in", "ist", "time",
+                      "same", "day", "this", "next", "coming", "us", "we", "can", "if", "is"}
+# Number of emails processed concurrently by the email pipeline.
+MAX_CONCURRENT_EMAILS = 8
+# Replies are drafted and sent concurrently; 429/5xx responses are retried with exponential backoff.
+MAX_CONCURRENT_SENDS = 8
+SEND_RETRIES = 4
+BACKOFF_BASE_SECONDS = 1
+BACKOFF_MAX_SECONDS = 30
+# A pending reply claim older than this belongs to a send that crashed or was interrupted, not one in flight.
+REPLY_CLAIM_STALE_SECONDS = 10 * 60
+# Approximate prompt budget for the email rows the sidebar assistant sends with each question.
+CHAT_CONTEXT_TOKEN_BUDGET = 3000
+CHAT_STOPWORDS = {"the", "and", "for", "are", "any", "what", "which", "show", "details", "quote", "quotes",
+                  "quotation", "quotations", "there", "with", "from", "about", "latest", "all", "list", "give",
+                  "tell", "me", "of", "is", "do", "we", "have", "our", "under", "below", "over", "above", "than",
+                  "less", "more", "price", "prices", "cost", "days", "lead", "time", "email", "emails", "supplier",
+                  "suppliers", "partial", "complete", "new", "business", "connection", "connections", "who", "how",
+                  "many", "much", "within", "delivery", "unit", "total", "per", "piece", "that", "this", "these",
+                  "cheapest", "cheaper", "lowest", "highest", "expensive", "sorted", "order", "week",
+                  "weeks", "month", "months", "can", "deliver"}
+# Questions with these words need reasoning over the data, so they skip the pandas fast path.
+OPEN_ENDED_PATTERN = r'\b(why|how|compare|comparison|recommend|best|better|worst|should|suggest|summar\w*|explain|negotiat\w*|trend|analy\w*)\b'
+QUOTE_FIELDS = ["product", "quantity", "unit_price", "total_cost", "lead_time"]
+# A quote is partial when one of these is missing; the table's Missing Fields and the chat answer both use them.
+REQUIRED_QUOTE_FIELDS = ["product", "quantity", "unit_price", "lead_time"]
+STRUCTURED_ANSWER_MAX_ROWS = 10
+# Modules app.py used to import at module level, and the ones it still does; compared by `startup-report`.
+STARTUP_DEFERRED_MODULES = ["pandas", "openai", "html2text", "googleapiclient.discovery", "google_auth_oauthlib.flow",
+                            "google.oauth2.credentials", "google.auth.transport.requests", "google_auth_httplib2"]
+STARTUP_EAGER_MODULES = ["streamlit", "pytz", "googleapiclient.errors"]
+# Headless worker (`python app.py worker`) defaults; a heartbeat older than WORKER_STALE_SECONDS reads as stopped.
+WORKER_INTERVAL_SECONDS = 300
+WORKER_BATCH_SIZE = 50
+WORKER_STALE_SECONDS = 3 * WORKER_INTERVAL_SECONDS
+# Backfills page through messages().list this many ids at a time; only one page is held in memory.
+BACKFILL_PAGE_SIZE = 100
+# HTML bodies at least this long skip html2text for the much faster HTMLParser extraction.
+FAST_HTML_MIN_CHARS = 20000
+# Body preprocessing: everything after one of these lines is earlier mail in the thread.
+EMAIL_BODY_TOKEN_BUDGET = 1500
+QUOTED_HISTORY_PATTERNS = [
+    r'^On\b.{0,200}\bwrote:\s*$',
+    r'^-{2,}\s*Original Message\s*-{2,}',
+    r'^_{10,}\s*$',
+    r'^\**From:\**\s.+\n\**(Sent|Date):\**\s',
+]
+# A From:/Date: header block right after one of these is a forwarded message, which is kept.
+FORWARDED_MARKER_PATTERN = r'(?:-{2,}\s*Forwarded message\s*-{2,}|Begin forwarded message:)\s*\Z'
+# A paragraph is a legal footer when it opens like one and uses footer vocabulary.
+DISCLAIMER_PATTERN = (r'^\W*(confidentiality|disclaimer|this e-?mail|this message|the information (contained|in this)|'
+                      r'please consider the environment|if you (have received|are not the intended))')
+DISCLAIMER_KEYWORDS = r'confidential|privileged|intended recipient|unauthori[sz]ed|virus|before printing|disclaimer'
+SIGNATURE_START_PATTERN = (r'^\s*(--\s*$|((best|kind|warm|with)\s+)?regards\b|thanks\b|thank you\b|sincerely\b|'
+                           r'cheers\b|yours (truly|faithfully|sincerely)\b)')
+# Process-wide OpenAI request budget; set these to the account's limits since every session shares the key.
+LLM_REQUESTS_PER_MINUTE = int(os.environ.get("LLM_REQUESTS_PER_MINUTE", "500"))
+LLM_TOKENS_PER_MINUTE = int(os.environ.get("LLM_TOKENS_PER_MINUTE", "30000"))
+LLM_MAX_CONCURRENCY = 16
+LLM_RETRIES = 4
+LLM_REQUEST_TIMEOUT_SECONDS = 60
+# Worst case for one request through the retry layer: every attempt times out and every backoff is the longest.
+LLM_RETRY_BUDGET_SECONDS = (LLM_RETRIES + 1) * LLM_REQUEST_TIMEOUT_SECONDS + LLM_RETRIES * BACKOFF_MAX_SECONDS
+# Per-stage time limits (seconds) for the email pipeline; LLM stages outlast the retry layer so that it, not the
+# stage, decides when a request has failed.
+STAGE_TIMEOUTS = {
+    "fetch": 30,
+    "analysis": LLM_RETRY_BUDGET_SECONDS + 30,
+    "meeting": LLM_RETRY_BUDGET_SECONDS + 30,
+    "classification": LLM_RETRY_BUDGET_SECONDS + 30,
+    "extraction": LLM_RETRY_BUDGET_SECONDS + 30
+}
+LLM_FAILURE_LABELS = {
+    "rate_limited": "Rate limited",
+    "timeout": "Timed out",
+    "unavailable": "Service unavailable",
+    "error": "Request failed"
+}
+# failed_emails states for failures outside the OpenAI request layer.
+FAILURE_LABELS = dict(LLM_FAILURE_LABELS, fetch="Could not fetch", processing="Processing error")
+# Gmail batch requests accept up to 100 calls, but Gmail throttles batches larger than 50.
+GMAIL_BATCH_SIZE = 50
+GMAIL_BATCH_RETRIES = 3
+# Partial response: only the parts of a message the pipeline reads.
+GMAIL_MESSAGE_FIELDS = "id,threadId,internalDate,payload(mimeType,headers,body/data,parts)"
+# Local store of processed emails, keyed by Gmail message id.
+EMAIL_STORE_PATH = os.environ.get("EMAIL_STORE_PATH", "processed_emails.sqlite3")
+# Busy intervals are fetched once per window with a freeBusy query and reused for conflict checks.
+FREEBUSY_WINDOW_DAYS = 14
+FREEBUSY_TTL_SECONDS = 120
+# Last Gmail historyId seen per mailbox, used to fetch only mail added since the previous run.
+SYNC_STATE_PATH = "sync_state.json"
+# Disk-backed cache for LLM completions, keyed on model, prompt hash and sampling parameters.
+LLM_CACHE_PATH = os.environ.get("LLM_CACHE_PATH", "llm_cache.sqlite3")
+LLM_CACHE_TTL_SECONDS = 7 * 24 * 60 * 60
+LLM_CACHE_MAX_ENTRIES = 20000
+llm_cache_settings = {"enabled": os.environ.get("LLM_CACHE_DISABLED", "") == ""}
+EXTRACTION_GUIDELINES = """EXTRACTION GUIDELINES:
+    1. PRODUCTS/ITEMS:
+       - Look for product names, item descriptions, part numbers, SKUs, model numbers
+       - Include brand names if mentioned
+       - Be specific about the product (e.g., "SKF Deep Groove Ball Bearing 6205-2RS" not just "bearing")
+    2. QUANTITIES/UNITS:
+       - Extract numerical quantities (e.g., "5 units", "100 pieces", "2 boxes")
+       - Return just the number with unit type (e.g., "50 pieces")
+    3. UNIT PRICE:
+       - Extract ONLY the price per single unit/item as a clean number with currency
+       - Look for currency symbols ($, €, ₹, etc.) and amounts
+       - Return ONLY the price (e.g., "₹180" or "$25.50")
+       - Look for terms like: "unit price", "per piece", "each", "price per unit"
+       - If you need to calculate unit price from total and quantity, do the math and return only the result
+       - NEVER return explanatory text, only the price value
+    4. TOTAL COST:
+       - Extract final/total amount for the entire order
+       - Look for terms like: "total", "total amount", "grand total", "final cost", "total price"
+       - Include currency symbol (e.g., "$1275.00", "₹60000")
+       - Return ONLY the amount with currency, no descriptive text
+    5. LEAD TIME:
+       - Extract time frames for delivery or production in DAYS
+       - Look for: "delivery time", "lead time", "shipping time", "ready in", "available in"
+       - Convert to days if given in weeks/months (e.g., "2 weeks" = "14 days")
+       - Return format e.g., "7 days", "10-15 days", "21 days"
+    6. SUPPLIER PLACE/LOCATION:
+       - Look for supplier's city, state, or location in email signature (e.g., "Mumbai", "Kolkata"). Return only that value.
+    7. SENDER NAME:
+       - Extract personal name from email signature (e.g., "Rakshan"). Return only that value.
+    8. COMPANY NAME:
+       - Extract company or organization name from signature (e.g., "TamilNadu Bearing Industries Ltd."). Return only that value.
+    9. CONTACT NUMBER:
+       - Extract phone number (e.g., "+91 7661598752")
+    10. DESIGNATION:
+       - Extract sender's designation or job title (e.g., "Sales Manager")"""
 if 'authenticated' not in st.session_state:
     st.session_state.authenticated = False
 if 'gmail_service' not in st.session_state:
     st.session_state.gmail_service = None
 if 'calendar_service' not in st.session_state:
     st.session_state.calendar_service = None
+if 'account' not in st.session_state:
+    st.session_state.account = None
 if 'processed_emails' not in st.session_state:
     st.session_state.processed_emails = []
+    st.session_state.processed_emails_loaded = False
+    st.session_state.store_revision = None
+if 'reply_drafts' not in st.session_state:
+    st.session_state.reply_drafts = {}
+if 'data_version' not in st.session_state:
+    # Bumped whenever processed_emails changes; the cached tables are keyed on it.
+    st.session_state.data_version = 0
+    st.session_state.table_session_id = uuid.uuid4().hex
 if 'chat_messages' not in st.session_state:
     st.session_state.chat_messages = [
         {"role": "assistant",
@@ -77,31 +363,214 @@ def chatbot_response(prompt):
                     response = f"Error: {str(e)}"
                     st.write(response)
                     st.session_state.chat_messages.append({"role": "assistant", "content": response})
-def generate_response(query, processed_emails):
-    email_context = []
+def estimate_tokens(text):
+    # Roughly four characters per token for English text and JSON.
+    return len(text) // 4 + 1
+def parse_amount(value):
+    match = re.search(r'\d[\d,]*(?:\.\d+)?', value or "")
+    return float(match.group(0).replace(',', '')) if match else None
+def compact_email_summary(email):
+    qd = email['quotation_data']
+    summary = {
+        "email_address": email['email_address'],
+        "subject": email['subject'],
+        "classification": email['final_classification']
+    }
+    for key in ("product", "quantity", "unit_price", "total_cost", "lead_time", "sender_name", "company_name",
+                "place", "contact_number", "designation"):
+        if qd.get(key, 'Not present') != 'Not present':
+            summary[key] = qd[key]
+    meeting_status = get_meeting_status(email.get('meeting_details'), email.get('meeting_result'))
+    if meeting_status != "No Meeting Requested":
+        summary["meeting_status"] = meeting_status
+    return summary
+def _query_limit(query, units=None):
+    """Return ("max" or "min", number, currency code or None) for phrases like "under $10", or like "more than
+    2 weeks" when units maps unit words to multipliers; the number is then converted, e.g. to days."""
+    subject = r'(' + "|".join(units) + r')s?\b' if units else r'()'
+    match = re.search(r'(under|below|less\s+than|cheaper\s+than|within|at\s+most|<=?|over|above|more\s+than|at\s+least|>=?)'
+                      r'\s*(' + CURRENCY_PATTERN + r')?\s*(\d[\d,]*(?:\.\d+)?)\s*' + subject, query, re.IGNORECASE)
+    if not match:
+        return None
+    kind = "min" if re.match(r'over|above|more|at\s+least|>', match.group(1), re.IGNORECASE) else "max"
+    number = float(match.group(3).replace(',', ''))
+    currency = CURRENCY_CODES.get(match.group(2).lower()) if match.group(2) else None
+    return kind, number * units[match.group(4).lower()] if units else number, currency
+def _query_terms(lowered, limits):
+    # Numbers belonging to a price or lead-time limit are not search terms; part numbers like "6205" are.
+    limit_numbers = {limit[1] for limit in limits if limit}
+    # Plurals are searched as their singular, which also matches the plural: "bearings" finds "Bearing 6205".
+    return list(dict.fromkeys(term[:-1] if len(term) > 3 and term.endswith('s') else term
+                              for term in re.findall(r'[a-z0-9][a-z0-9\-]{2,}', lowered)
+                              if term not in CHAT_STOPWORDS
+                              and not (re.fullmatch(r'[\d.]+', term) and float(term.rstrip('.')) in limit_numbers)))
+def _within_limit(value, limit):
+    if limit is None:
+        return True
+    if value is None:
+        return False
+    kind, number = limit[:2]
+    return value <= number if kind == "max" else value >= number
+def retrieve_relevant_emails(query, processed_emails, token_budget=CHAT_CONTEXT_TOKEN_BUDGET):
+    """Select the rows relevant to query and pack them as compact JSON within token_budget.
+    Returns (context_json, rows_included, rows_matching)."""
+    lowered = query.lower()
+    classifications = set()
+    if "partial" in lowered:
+        classifications.add("Quotation Partially Received")
+    if re.search(r'\bcomplete\b|\bfull\b', lowered):
+        classifications.add("Quotation Received")
+    if re.search(r'new business|business connection|introduc|new supplier', lowered):
+        classifications.add("New Business Connection")
+    lead_limit = _query_limit(query, LEAD_TIME_UNIT_DAYS)
+    price_limit = None if lead_limit else _query_limit(query)
+    terms = _query_terms(lowered, [lead_limit, price_limit])
+    candidates = []
+    for position, email in enumerate(processed_emails):
+        qd = email['quotation_data']
+        if classifications and email['final_classification'] not in classifications:
+            continue
+        if not _within_limit(parse_amount(qd.get('unit_price', 'Not present')), price_limit):
+            continue
+        if price_limit and price_limit[2] and parse_price(qd.get('unit_price', 'Not present'))[1] != price_limit[2]:
+            continue
+        lead_days = re.findall(r'\d+', qd.get('lead_time', ''))
+        if not _within_limit(float(max(map(int, lead_days))) if lead_days else None, lead_limit):
+            continue
+        haystack = " ".join(str(qd.get(key, '')) for key in ("product", "company_name", "sender_name", "place"))
+        haystack = f"{haystack} {email['subject']} {email['email_address']}".lower()
+        score = sum(term in haystack for term in terms)
+        candidates.append((score, position, email))
+    # When the question names something (a product, a company) keep only the rows that mention it.
+    if any(score for score, _, _ in candidates):
+        candidates = [candidate for candidate in candidates if candidate[0]]
+    candidates.sort(key=lambda candidate: (-candidate[0], candidate[1]))
+    rows = []
+    used = 2
+    for _, _, email in candidates:
+        row = json.dumps(compact_email_summary(email), separators=(',', ':'), ensure_ascii=False)
+        if used + estimate_tokens(row) > token_budget:
+            break
+        rows.append(row)
+        used += estimate_tokens(row) + 1
+    return "[" + ",".join(rows) + "]", len(rows), len(candidates)
+def quote_table(processed_emails):
+    """One row per processed email with numeric unit price and lead-time columns for vectorized filtering."""
+    import pandas as pd
+    rows = []
     for email in processed_emails:
         qd = email['quotation_data']
-        email_summary = {
-            "email_address": email['email_address'],
-            "subject": email['subject'],
-            "classification": email['final_classification'],
-            "product": qd.get('product', 'Not present'),
-            "quantity": qd.get('quantity', 'Not present'),
-            "unit_price": qd.get('unit_price', 'Not present'),
-            "total_cost": qd.get('total_cost', 'Not present'),
-            "lead_time": qd.get('lead_time', 'Not present'),
-            "sender_name": qd.get('sender_name', 'Not present'),
-            "company_name": qd.get('company_name', 'Not present'),
-            "place": qd.get('place', 'Not present'),
-            "contact_number": qd.get('contact_number', 'Not present'),
-            "designation": qd.get('designation', 'Not present'),
-            "meeting_status": get_meeting_status(email.get('meeting_details'), email.get('meeting_result'))
-        }
-        email_context.append(email_summary)
+        row = {key: qd.get(key, 'Not present') for key in QUOTE_FIELDS + ["company_name", "sender_name"]}
+        row.update(email_address=email['email_address'], subject=email['subject'],
+                   classification=email['final_classification'])
+        rows.append(row)
+    df = pd.DataFrame(rows, columns=QUOTE_FIELDS + ["company_name", "sender_name", "email_address", "subject",
+                                                    "classification"])
+    normalized = normalize_quotations([email['quotation_data'] for email in processed_emails])
+    df['unit_price_value'] = pd.to_numeric(normalized['unit_price_amount'], errors='coerce')
+    df['unit_price_currency'] = normalized['unit_price_currency']
+    # The upper bound of a range such as "10-12 days" is what the supplier commits to.
+    df['lead_time_days'] = pd.to_numeric(normalized['lead_time_max_days'], errors='coerce')
+    df['supplier'] = df['company_name'].where(df['company_name'] != 'Not present', df['email_address'])
+    df['search_text'] = (df['product'] + " " + df['company_name'] + " " + df['sender_name'] + " "
+                         + df['subject'] + " " + df['email_address']).str.lower()
+    return df
+def _format_quote_rows(df, describe):
+    lines = [describe(row) for row in df.head(STRUCTURED_ANSWER_MAX_ROWS).itertuples()]
+    if len(df) > STRUCTURED_ANSWER_MAX_ROWS:
+        lines.append(f"...and {len(df) - STRUCTURED_ANSWER_MAX_ROWS} more.")
+    return "\n".join(lines)
+def _describe_quote(row):
+    details = [f"{row.unit_price}/unit" if row.unit_price != 'Not present' else "unit price not given"]
+    if row.quantity != 'Not present':
+        details.append(f"qty {row.quantity}")
+    if row.total_cost != 'Not present':
+        details.append(f"total {row.total_cost}")
+    if row.lead_time != 'Not present':
+        details.append(f"lead time {row.lead_time}")
+    return f"- {row.product} from {row.supplier}: " + ", ".join(details)
+def _term_mask(df, terms):
+    import pandas as pd
+    mask = pd.Series(True, index=df.index)
+    for term in terms:
+        mask &= df['search_text'].str.contains(term, regex=False)
+    return mask
+def _unmatched_terms(df, terms):
+    """Search terms that appear in no row of the quote table."""
+    return [term for term in terms if not df['search_text'].str.contains(term, regex=False).any()]
+def answer_structured_query(query, processed_emails):
+    """Answer the common filter-style questions straight from the quote table.
+    Returns None when the question is open-ended or not recognized, so the caller can ask the LLM."""
+    import pandas as pd
+    lowered = query.lower()
+    if not processed_emails or re.search(OPEN_ENDED_PATTERN, lowered):
+        return None
+    df = quote_table(processed_emails)
+    if "partial" in lowered:
+        partial = df[df['classification'] == "Quotation Partially Received"]
+        terms = _query_terms(lowered, [])
+        if terms:
+            if _unmatched_terms(df, terms):
+                return None
+            partial = partial[_term_mask(partial, terms)]
+        if partial.empty:
+            matching = f" matching {' '.join(terms)}" if terms else ""
+            return f"There are no partial quotes{matching} among the processed emails."
+        missing = partial[REQUIRED_QUOTE_FIELDS].eq('Not present')
+        def describe(row):
+            fields = [field.replace('_', ' ') for field in REQUIRED_QUOTE_FIELDS if missing.at[row.Index, field]]
+            return f"- {row.product} from {row.supplier}: missing {', '.join(fields) or 'no fields'}"
+        return f"{len(partial)} partial quote(s):\n" + _format_quote_rows(partial, describe)
+    quotes = df[df['classification'].isin(["Quotation Received", "Quotation Partially Received"])]
+    mask = pd.Series(True, index=quotes.index)
+    conditions = []
+    lead_limit = _query_limit(query, LEAD_TIME_UNIT_DAYS)
+    if lead_limit:
+        kind, number, _ = lead_limit
+        mask &= quotes['lead_time_days'].le(number) if kind == "max" else quotes['lead_time_days'].ge(number)
+        conditions.append(f"lead time {'up to' if kind == 'max' else 'of at least'} {number:g} days")
+    price_limit = None if lead_limit else _query_limit(query)
+    if price_limit:
+        kind, number, currency = price_limit
+        mask &= quotes['unit_price_value'].le(number) if kind == "max" else quotes['unit_price_value'].ge(number)
+        if currency:
+            # Amounts in different currencies are not comparable; only quotes in the asked currency qualify.
+            mask &= quotes['unit_price_currency'].eq(currency)
+        symbol = CURRENCY_DISPLAY.get(currency, "")
+        conditions.append(f"unit price {'up to' if kind == 'max' else 'of at least'} {symbol}{number:g}")
+    terms = _query_terms(lowered, [lead_limit, price_limit])
+    if terms:
+        if _unmatched_terms(quotes, terms):
+            # A word no quote mentions is something the table cannot answer; let the LLM interpret the question.
+            return None
+        mask &= _term_mask(quotes, terms)
+        conditions.append("matching " + " ".join(terms))
+    if not conditions:
+        return None
+    matches = quotes[mask]
+    if re.search(r'cheap|lowest|low\s+to\s+high', lowered):
+        matches = matches.sort_values('unit_price_value', kind='stable')
+    if matches.empty:
+        return f"No quotes found with {' and '.join(conditions)}."
+    currencies = matches['unit_price_currency'].fillna('')
+    if price_limit and not price_limit[2] and currencies.nunique() > 1:
+        # The limit names no currency and amounts in different currencies are not comparable; list each separately.
+        sections = [f"In {currency or 'no stated currency'}:\n" + _format_quote_rows(group, _describe_quote)
+                    for currency, group in matches.groupby(currencies, sort=True)]
+        return f"{len(matches)} quote(s) with {' and '.join(conditions)}, by currency:\n" + "\n".join(sections)
+    return f"{len(matches)} quote(s) with {' and '.join(conditions)}:\n" + _format_quote_rows(matches, _describe_quote)
+def generate_response(query, processed_emails, token_budget=CHAT_CONTEXT_TOKEN_BUDGET):
+    answer = answer_structured_query(query, processed_emails)
+    if answer is not None:
+        return answer
+    email_context, included, matching = retrieve_relevant_emails(query, processed_emails, token_budget)
+    dropped = matching - included
+    if dropped:
+        logger.info(f"Chat context trimmed to {included} of {matching} matching emails")
     prompt = f"""
     You are a supplier quotation assistant. Answer the user's query concisely and precisely based on the processed email data.
     USER QUERY: "{query}"
-    PROCESSED EMAILS: {json.dumps(email_context, indent=2)}
+    PROCESSED EMAILS ({included} of {matching} matching emails; fields that are not present are omitted): {email_context}
     GUIDELINES:
     - Provide a direct, concise response (max 100 words).
     - Focus on the query's intent (e.g., partial quotes, specific products, price ranges).
@@ -113,46 +582,62 @@ def generate_response(query, processed_emails):
     RESPONSE:
     """
     try:
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[{'role': "user", "content": prompt}],
-            temperature=0.2,
-            max_tokens=200
-        )
-        return response.choices[0].message.content.strip() or "No relevant information found."
+        response = llm_complete(prompt, temperature=0.2, max_tokens=200)
+        answer = response.strip() or "No relevant information found."
+    except LLMError as e:
+        return f"The assistant is unavailable right now ({LLM_FAILURE_LABELS[e.state].lower()}); please try again shortly."
     except Exception as e:
         return f"Error processing query: {str(e)}"
-def authenticate_gmail_and_calendar():
-    creds = None
-    refresh_token = None
+    if dropped:
+        answer += f"\n\n_Based on the {included} most relevant of {matching} matching emails._"
+    return answer
+def build_google_services(creds):
+    from googleapiclient.discovery import build
+    # The discovery documents ship with google-api-python-client; no network round trip per build.
+    gmail_service = build('gmail', 'v1', credentials=creds, static_discovery=True, cache_discovery=False)
+    calendar_service = build('calendar', 'v3', credentials=creds, static_discovery=True, cache_discovery=False)
+    return gmail_service, calendar_service
+@st.cache_resource(show_spinner=False)
+def google_credentials(refresh_token):
+    from google.oauth2.credentials import Credentials
+    return Credentials(
+        token=None,
+        refresh_token=refresh_token,
+        token_uri='https://oauth2.googleapis.com/token',
+        client_id=st.secrets['CLIENT_ID'],
+        client_secret=st.secrets['CLIENT_SECRET'],
+        scopes=SCOPES
+    )
+@st.cache_resource(show_spinner=False)
+def google_services(refresh_token):
+    """Gmail and Calendar services shared by every session using refresh_token. The access token is
+    refreshed only when it has expired; requests go through thread_http, so sharing is safe."""
+    creds = google_credentials(refresh_token)
+    if not creds.valid:
+        from google.auth.transport.requests import Request
+        creds.refresh(Request())
+    return build_google_services(creds)
+def load_refresh_token():
     # Step 1: Try refresh token from secrets first
     if 'REFRESH_TOKEN' in st.secrets and st.secrets['REFRESH_TOKEN']:
-        refresh_token = st.secrets['REFRESH_TOKEN']
-    else:
-        # Step 2: Try loading from file (local dev)
-        try:
-            with open("refresh_token.json", "r") as f:
-                refresh_token = json.load(f).get('refresh_token')
-        except FileNotFoundError:
-            pass
+        return st.secrets['REFRESH_TOKEN']
+    # Step 2: Try loading from file (local dev)
+    try:
+        with open("refresh_token.json", "r") as f:
+            return json.load(f).get('refresh_token')
+    except FileNotFoundError:
+        return None
+def authenticate_gmail_and_calendar():
+    creds = None
+    refresh_token = load_refresh_token()
     # If we have a refresh token → try using it
     if refresh_token:
         try:
-            creds = Credentials(
-                token=None,
-                refresh_token=refresh_token,
-                token_uri='https://oauth2.googleapis.com/token',
-                client_id=st.secrets['CLIENT_ID'],
-                client_secret=st.secrets['CLIENT_SECRET'],
-                scopes=SCOPES
-            )
-            creds.refresh(Request())
-            gmail_service = build('gmail', 'v1', credentials=creds)
-            calendar_service = build('calendar', 'v3', credentials=creds)
-            return gmail_service, calendar_service
+            return google_services(refresh_token)
         except Exception as e:
             st.warning(f"Could not refresh token: {e}")
     # Step 3: OAuth flow
+    from google_auth_oauthlib.flow import Flow
     redirect_uri = "https://supplier-po-agent-xtjqg94yfzebumnw6weqff.streamlit.app"
     flow = Flow.from_client_config(
         {
@@ -184,9 +669,7 @@ def authenticate_gmail_and_calendar():
             )
         else:
             st.error("No refresh token received. Revoke access and try again.")
-        gmail_service = build('gmail', 'v1', credentials=creds)
-        calendar_service = build('calendar', 'v3', credentials=creds)
-        return gmail_service, calendar_service
+        return build_google_services(creds)
     else:
         auth_url, _ = flow.authorization_url(
             prompt='consent',
@@ -195,69 +678,294 @@ def authenticate_gmail_and_calendar():
         )
         st.markdown(f"[Click here to authorize access]({auth_url})")
     return None, None
-def get_email_body(msg_payload):
-    body = ""
-    if 'parts' in msg_payload:
-        for part in msg_payload['parts']:
-            mime_type = part.get("mimeType")
-            body_data = part.get("body", {}).get("data")
-            if mime_type == "text/plain" and body_data:
-                body = base64.urlsafe_b64decode(body_data).decode('utf-8')
-                break
-            elif mime_type == "text/html" and body_data:
-                html_body = base64.urlsafe_b64decode(body_data).decode('utf-8')
-                body = html2text.html2text(html_body)
-                break
-            elif "parts" in part:
-                body = get_email_body(part)
-                if body:
-                    break
+def iter_body_parts(msg_payload):
+    """Yield the leaf parts of a Gmail payload that carry inline body data, depth first in document order."""
+    stack = [msg_payload]
+    while stack:
+        part = stack.pop()
+        if part.get("parts"):
+            stack.extend(reversed(part["parts"]))
+        elif part.get("body", {}).get("data") and not part.get("filename"):
+            yield part
+def decode_part(part):
+    data = base64.urlsafe_b64decode(part["body"]["data"])
+    content_type = next((h["value"] for h in part.get("headers", []) if h["name"].lower() == "content-type"), "")
+    match = re.search(r'charset="?([\w.:-]+)', content_type, re.IGNORECASE)
+    try:
+        return data.decode(match.group(1) if match else 'utf-8', errors='replace')
+    except LookupError:
+        return data.decode('utf-8', errors='replace')
+class _HTMLTextExtractor(HTMLParser):
+    BLOCK_TAGS = {"p", "div", "br", "tr", "li", "table", "h1", "h2", "h3", "h4", "h5", "h6", "blockquote", "hr"}
+    SKIP_TAGS = {"script", "style", "head", "title"}
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.chunks = []
+        self.skipping = 0
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIP_TAGS:
+            self.skipping += 1
+        elif tag in self.BLOCK_TAGS:
+            self.chunks.append("\n")
+        elif tag in ("td", "th"):
+            self.chunks.append(" ")
+    def handle_endtag(self, tag):
+        if tag in self.SKIP_TAGS:
+            self.skipping = max(self.skipping - 1, 0)
+        elif tag in self.BLOCK_TAGS:
+            self.chunks.append("\n")
+    def handle_data(self, data):
+        if not self.skipping:
+            self.chunks.append(data)
+def html_to_text(html_body, fast_html_min_chars=FAST_HTML_MIN_CHARS):
+    if len(html_body) < fast_html_min_chars:
+        import html2text
+        return html2text.html2text(html_body)
+    extractor = _HTMLTextExtractor()
+    extractor.feed(html_body)
+    extractor.close()
+    text = re.sub(r'[ \t\u00a0]+', ' ', "".join(extractor.chunks))
+    return re.sub(r'\n\s*\n\s*', '\n\n', text).strip()
+def get_email_body(msg_payload, fast_html_min_chars=FAST_HTML_MIN_CHARS):
+    # Prefer a text/plain alternative anywhere in the tree; fall back to the first HTML part.
+    html_part = None
+    for part in iter_body_parts(msg_payload):
+        mime_type = part.get("mimeType", "text/plain")
+        if mime_type == "text/plain":
+            return decode_part(part)
+        if mime_type == "text/html" and html_part is None:
+            html_part = part
+    if html_part is not None:
+        return html_to_text(decode_part(html_part), fast_html_min_chars)
+    return ""
+def eml_to_payload(message):
+    """Convert an email.message.Message into the Gmail API payload shape get_email_body expects."""
+    payload = {
+        "mimeType": message.get_content_type(),
+        "filename": message.get_filename() or "",
+        "headers": [{"name": name, "value": str(value)} for name, value in message.items()]
+    }
+    if message.is_multipart():
+        payload["parts"] = [eml_to_payload(part) for part in message.get_payload()]
+        payload["body"] = {"size": 0}
     else:
-        body_data = msg_payload.get("body", {}).get("data")
-        if body_data:
-            body = base64.urlsafe_b64decode(body_data).decode('utf-8')
-    return body
+        data = message.get_payload(decode=True) or b""
+        payload["body"] = {"data": base64.urlsafe_b64encode(data).decode(), "size": len(data)}
+    return payload
+def load_mime_samples(directory):
+    """Yield (name, payload) for every .eml file and Gmail API message .json file in directory."""
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if name.endswith(".eml"):
+            with open(path, "rb") as f:
+                yield name, eml_to_payload(email.message_from_binary_file(f))
+        elif name.endswith(".json"):
+            with open(path, "r", encoding="utf-8") as f:
+                message = json.load(f)
+            yield name, message.get("payload", message)
+def benchmark_mime(directory, repeats=3):
+    """Time get_email_body over a sample corpus with html2text for every HTML body versus the current path."""
+    samples = list(load_mime_samples(directory))
+    if not samples:
+        return f"No .eml or .json samples found in {directory}"
+    lines = []
+    totals = [0.0, 0.0]
+    for name, payload in samples:
+        timings = []
+        for threshold in (float("inf"), FAST_HTML_MIN_CHARS):
+            start = time.perf_counter()
+            for _ in range(repeats):
+                body = get_email_body(payload, threshold)
+            timings.append((time.perf_counter() - start) / repeats)
+        totals[0] += timings[0]
+        totals[1] += timings[1]
+        lines.append(f"{name[:40]:<42}{timings[0] * 1000:>9.1f} ms{timings[1] * 1000:>9.1f} ms{len(body):>9} chars")
+    lines.insert(0, f"{'sample':<42}{'html2text':>12}{'current':>12}{'body':>15}")
+    lines.append(f"{'total (' + str(len(samples)) + ' samples)':<42}{totals[0] * 1000:>9.1f} ms{totals[1] * 1000:>9.1f} ms")
+    return "\n".join(lines)
+def clean_email_body(body, token_budget=EMAIL_BODY_TOKEN_BUDGET):
+    """Reduce a body to what the prompts need: drop quoted history, legal footers, link and image markup and
+    extra whitespace, then fit it to token_budget while always keeping the signature block."""
+    text = body.replace('\r\n', '\n').replace('\r', '\n')
+    for pattern in QUOTED_HISTORY_PATTERNS:
+        for match in re.finditer(pattern, text, re.IGNORECASE | re.MULTILINE):
+            if re.search(FORWARDED_MARKER_PATTERN, text[:match.start()], re.IGNORECASE):
+                continue
+            if text[:match.start()].strip():
+                text = text[:match.start()]
+            break
+    text = re.sub(r'^\s*>.*\n?', '', text, flags=re.MULTILINE)
+    paragraphs = re.split(r'\n\s*\n', text)
+    text = "\n\n".join(p for p in paragraphs if not (re.search(DISCLAIMER_PATTERN, p.strip(), re.IGNORECASE)
+                                                      and re.search(DISCLAIMER_KEYWORDS, p, re.IGNORECASE)))
+    text = re.sub(r'!\[[^\]]*\]\([^)]*\)|\[image:[^\]]*\]|<mailto:[^>]*>', '', text, flags=re.IGNORECASE)
+    text = re.sub(r'\[([^\]]*)\]\([^)]*\)', r'\1', text)
+    # Tracking links carry nothing the prompts use; keep the host, which may be the supplier's website.
+    text = re.sub(r'<?https?://(?:www\.)?([^/\s>?#]+)[^\s>]*>?', r'\1', text)
+    text = re.sub(r'[ \t\u00a0]+', ' ', text)
+    text = re.sub(r' *\n *', '\n', text)
+    text = re.sub(r'\n{3,}', '\n\n', text).strip()
+    if estimate_tokens(text) <= token_budget:
+        return text
+    lines = text.split('\n')
+    signature_start = max(len(lines) - 8, 0)
+    for i in range(len(lines) - 1, max(len(lines) - 20, 0) - 1, -1):
+        if re.match(SIGNATURE_START_PATTERN, lines[i], re.IGNORECASE):
+            signature_start = i
+            break
+    signature = "\n".join(lines[signature_start:])[-token_budget * 2:]
+    head_chars = max(token_budget * 4 - len(signature) - 10, 0)
+    return "\n".join(lines[:signature_start])[:head_chars].rstrip() + "\n[...]\n" + signature
+def sqlite_connect(path):
+    conn = sqlite3.connect(path, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    return conn
+@st.cache_resource
+def llm_cache_stats():
+    return {"hits": 0, "misses": 0, "bypassed": 0, "writes": 0, "lock": threading.Lock()}
+def _count_llm_cache(event):
+    stats = llm_cache_stats()
+    with stats["lock"]:
+        stats[event] += 1
+        return stats[event]
+def llm_cache_connect():
+    conn = sqlite_connect(LLM_CACHE_PATH)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS llm_cache (
+            cache_key TEXT PRIMARY KEY,
+            model TEXT NOT NULL,
+            response TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            last_used_at REAL NOT NULL,
+            hits INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    return conn
+def llm_cache_key(model, prompt, temperature, max_tokens, response_format=None, now=None):
+    # Prompts that embed the current time are keyed on the calendar day instead of the exact instant,
+    # so relative dates ("tomorrow", "Monday") still resolve against the right day on a cache hit.
+    if now is not None:
+        prompt = prompt.replace(now.isoformat(), now.strftime('%Y-%m-%d (%A) %Z'))
+    payload = json.dumps({
+        "model": model,
+        "prompt_sha256": hashlib.sha256(prompt.encode('utf-8')).hexdigest(),
+        "temperature": temperature,
+        "max_tokens": max_tokens,
+        "response_format": response_format
+    }, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+def prune_llm_cache(conn=None):
+    """Drop expired entries and keep only the most recently used LLM_CACHE_MAX_ENTRIES rows."""
+    own_conn = conn is None
+    conn = conn or llm_cache_connect()
+    try:
+        with conn:
+            conn.execute("DELETE FROM llm_cache WHERE created_at < ?", (time.time() - LLM_CACHE_TTL_SECONDS,))
+            conn.execute("""
+                DELETE FROM llm_cache WHERE cache_key NOT IN (
+                    SELECT cache_key FROM llm_cache ORDER BY last_used_at DESC LIMIT ?
+                )
+            """, (LLM_CACHE_MAX_ENTRIES,))
+    finally:
+        if own_conn:
+            conn.close()
+def clear_llm_cache():
+    conn = llm_cache_connect()
+    try:
+        with conn:
+            conn.execute("DELETE FROM llm_cache")
+    finally:
+        conn.close()
+def _is_usable_response(content, validate):
+    if not content.strip():
+        return False
+    try:
+        validate(content)
+    except Exception:
+        return False
+    return True
+def llm_complete(prompt, temperature, max_tokens, model="gpt-4o", response_format=None, now=None, validate=None):
+    """Return the completion text for prompt, served from the disk cache when possible.
+    Pass now= when the prompt embeds the current datetime so the entry is keyed by day. Only responses that
+    finished normally and pass validate (a callable raising on an unusable response; JSON response formats
+    default to json.loads) are cached, so a retry asks again instead of replaying a bad response."""
+    if validate is None:
+        validate = json.loads if response_format else (lambda content: None)
+    if not llm_cache_settings["enabled"]:
+        _count_llm_cache("bypassed")
+        return _create_completion(prompt, temperature, max_tokens, model, response_format)[0]
+    key = llm_cache_key(model, prompt, temperature, max_tokens, response_format, now)
+    conn = llm_cache_connect()
+    try:
+        row = conn.execute("SELECT response, created_at FROM llm_cache WHERE cache_key = ?", (key,)).fetchone()
+        # Entries written before responses were validated may be unusable; those count as misses.
+        if row and time.time() - row[1] < LLM_CACHE_TTL_SECONDS and _is_usable_response(row[0], validate):
+            with conn:
+                conn.execute("UPDATE llm_cache SET last_used_at = ?, hits = hits + 1 WHERE cache_key = ?",
+                             (time.time(), key))
+            _count_llm_cache("hits")
+            return row[0]
+        _count_llm_cache("misses")
+        content, finish_reason = _create_completion(prompt, temperature, max_tokens, model, response_format)
+        if finish_reason != "length" and _is_usable_response(content, validate):
+            with conn:
+                conn.execute("INSERT OR REPLACE INTO llm_cache VALUES (?, ?, ?, ?, ?, 0)",
+                             (key, model, content, time.time(), time.time()))
+            if _count_llm_cache("writes") % 100 == 0:
+                prune_llm_cache(conn)
+        return content
+    finally:
+        conn.close()
+def _create_completion(prompt, temperature, max_tokens, model, response_format):
+    """The only place a completion is requested: rate limited, retried with jittered backoff, and raising
+    LLMError with a distinct state once it gives up. Returns (content, finish_reason)."""
+    import openai
+    kwargs = {"response_format": response_format} if response_format else {}
+    limiter = llm_rate_limiter()
+    for attempt in range(LLM_RETRIES + 1):
+        reserved = limiter.acquire(estimate_tokens(prompt) + max_tokens)
+        try:
+            response = openai_client().chat.completions.create(
+                model=model,
+                messages=[{"role": "user", "content": prompt}],
+                temperature=temperature,
+                max_tokens=max_tokens,
+                **kwargs
+            )
+        except openai.RateLimitError as e:
+            limiter.release(reserved, rate_limited=True, retry_after=_retry_after_seconds(e))
+            if getattr(e, "code", None) == "insufficient_quota":
+                raise LLMError("rate_limited", f"OpenAI quota exhausted: {e}") from e
+            state, error = "rate_limited", e
+        except openai.APITimeoutError as e:
+            limiter.release(reserved)
+            state, error = "timeout", e
+        except (openai.APIConnectionError, openai.InternalServerError) as e:
+            limiter.release(reserved)
+            state, error = "unavailable", e
+        except openai.APIStatusError as e:
+            # Other 4xx responses will not succeed on retry.
+            limiter.release(reserved)
+            raise LLMError("error", f"OpenAI request failed: {e}") from e
+        except BaseException:
+            limiter.release(reserved)
+            raise
+        else:
+            usage = getattr(response, "usage", None)
+            limiter.release(reserved, used=getattr(usage, "total_tokens", None))
+            choice = response.choices[0]
+            return choice.message.content or "", choice.finish_reason
+        if attempt < LLM_RETRIES:
+            time.sleep(backoff_delay(attempt))
+    raise LLMError(state, f"OpenAI request {LLM_FAILURE_LABELS[state].lower()} after {LLM_RETRIES + 1} attempts: "
+                          f"{error}") from error
 def ask_openai(question, context):
     prompt = f"""
     You are a specialized Purchase Order (PO) and supplier quotation data extraction assistant. Your task is to analyze business emails from suppliers and extract specific information accurately.
     EMAIL CONTENT TO ANALYZE:
     {context}
     QUESTION: {question}
-    EXTRACTION GUIDELINES:
-    1. PRODUCTS/ITEMS:
-       - Look for product names, item descriptions, part numbers, SKUs, model numbers
-       - Include brand names if mentioned
-       - Be specific about the product (e.g., "SKF Deep Groove Ball Bearing 6205-2RS" not just "bearing")
-    2. QUANTITIES/UNITS:
-       - Extract numerical quantities (e.g., "5 units", "100 pieces", "2 boxes")
-       - Return just the number with unit type (e.g., "50 pieces")
-    3. UNIT PRICE:
-       - Extract ONLY the price per single unit/item as a clean number with currency
-       - Look for currency symbols ($, €, ₹, etc.) and amounts
-       - Return ONLY the price (e.g., "₹180" or "$25.50")
-       - Look for terms like: "unit price", "per piece", "each", "price per unit"
-       - If you need to calculate unit price from total and quantity, do the math and return only the result
-       - NEVER return explanatory text, only the price value
-    4. TOTAL COST:
-       - Extract final/total amount for the entire order
-       - Look for terms like: "total", "total amount", "grand total", "final cost", "total price"
-       - Include currency symbol (e.g., "$1275.00", "₹60000")
-       - Return ONLY the amount with currency, no descriptive text
-    5. LEAD TIME:
-       - Extract time frames for delivery or production in DAYS
-       - Look for: "delivery time", "lead time", "shipping time", "ready in", "available in"
-       - Convert to days if given in weeks/months (e.g., "2 weeks" = "14 days")
-       - Return format e.g., "7 days", "10-15 days", "21 days"
-    6. SUPPLIER PLACE/LOCATION:
-       - Look for supplier's city, state, or location in email signature (e.g., "Mumbai", "Kolkata"). Return only that value.
-    7. SENDER NAME:
-       - Extract personal name from email signature (e.g., "Rakshan"). Return only that value.
-    8. COMPANY NAME:
-       - Extract company or organization name from signature (e.g., "TamilNadu Bearing Industries Ltd."). Return only that value.
-    9. CONTACT NUMBER:
-       - Extract phone number (e.g., "+91 7661598752")
-    10. DESIGNATION:
-       - Extract sender's designation or job title (e.g., "Sales Manager")
+    {EXTRACTION_GUIDELINES}
     RESPONSE RULES:
     - Extract ONLY explicitly stated info.
     - These responses are fed into a tabular format. So, just return what is asked for.
@@ -268,37 +976,190 @@ def ask_openai(question, context):
     ANSWER:
     """
     try:
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[{"role": "user", "content": prompt}],
+        response = llm_complete(prompt, temperature=0.3, max_tokens=250)
+        return response.strip() or "Not present"
+    except LLMError:
+        raise
+    except Exception as e:
+        raise LLMError("error", f"Extraction failed: {e}") from e
+def normalize_extracted_value(value):
+    value = str(value or "").strip()
+    if not value or value.lower().rstrip('.') in ("not present", "n/a", "none", "null", "not mentioned"):
+        return "Not present"
+    return value
+def ask_openai_structured(field_mapping, context):
+    """Answer every question in field_mapping with a single JSON-schema constrained completion."""
+    keys = list(field_mapping.values())
+    schema = {
+        "type": "object",
+        "properties": {key: {"type": "string", "description": question} for question, key in field_mapping.items()},
+        "required": keys,
+        "additionalProperties": False
+    }
+    questions = "\n".join(f'    - "{key}": {question}' for question, key in field_mapping.items())
+    prompt = f"""
+    You are a specialized Purchase Order (PO) and supplier quotation data extraction assistant. Your task is to analyze business emails from suppliers and extract specific information accurately.
+    EMAIL CONTENT TO ANALYZE:
+    {context}
+    QUESTIONS (answer each one under its JSON key):
+{questions}
+    {EXTRACTION_GUIDELINES}
+    RESPONSE RULES:
+    - Extract ONLY explicitly stated info.
+    - These responses are fed into a tabular format. So, for each key just return what is asked for.
+    - Do not hallucinate or take from the examples given above in this prompt
+    - If a value is not found, use "Not present" for that key
+    - Keep original format for non-price fields
+    - Don't assume or guess, only state exact extracted values
+    - Respond with a JSON object containing every key listed above
+    """
+    try:
+        response = llm_complete(
+            prompt,
             temperature=0.3,
-            max_tokens=250
+            max_tokens=100 + 60 * len(keys),
+            response_format={
+                "type": "json_schema",
+                "json_schema": {"name": "quotation_fields", "strict": True, "schema": schema}
+            }
         )
-        return response.choices[0].message.content.strip() or "Not present"
+        answers = json.loads(response)
+    except LLMError:
+        raise
     except Exception as e:
-        return f"Error: {str(e)}"
-def classify_email_intent(context):
+        # An unparseable response has no usable values; the email is recorded as failed, not stored.
+        raise LLMError("error", f"Extraction response was not valid JSON: {e}") from e
+    return {key: normalize_extracted_value(answers.get(key)) for key in keys}
+def classify_email_intent_with_source(context):
+    """Classify with the local model when it is confident enough; returns (classification, "local" or "llm")."""
+    classification = classify_email_intent_locally(context)
+    if classification:
+        return classification, "local"
+    return classify_email_intent_llm(context), "llm"
+def classify_email_intent_locally(context):
+    """Return the local model's classification when it clears LOCAL_CLASSIFIER_THRESHOLD, else None."""
+    model = current_intent_model()
+    if model:
+        classification, confidence = predict_intent(model, context)
+        if confidence >= LOCAL_CLASSIFIER_THRESHOLD:
+            return classification
+    return None
+def intent_features(context):
+    # Word unigrams and bigrams plus markers for the quotation fields the rule extractor can see.
+    words = re.findall(r"[a-z][a-z']+", context.lower())
+    features = words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+    features += [f"__{key}__" for key in rule_extract_fields(context)]
+    return features
+def train_intent_model(examples):
+    """Fit a multinomial Naive Bayes model on [(body, classification)] pairs."""
+    token_counts = {label: {} for label in INTENT_LABELS}
+    label_counts = dict.fromkeys(INTENT_LABELS, 0)
+    vocabulary = set()
+    for body, label in examples:
+        label_counts[label] += 1
+        for token in intent_features(body):
+            token_counts[label][token] = token_counts[label].get(token, 0) + 1
+            vocabulary.add(token)
+    labels = [label for label in INTENT_LABELS if label_counts[label]]
+    model = {"labels": labels, "log_priors": {}, "log_likelihoods": {}, "unseen_log_likelihood": {},
+             "examples": len(examples), "trained_at": datetime.now(pytz.utc).isoformat()}
+    for label in labels:
+        total = sum(token_counts[label].values()) + len(vocabulary)
+        model["log_priors"][label] = math.log(label_counts[label] / len(examples))
+        model["log_likelihoods"][label] = {
+            token: math.log((count + 1) / total) for token, count in token_counts[label].items()
+        }
+        model["unseen_log_likelihood"][label] = math.log(1 / total)
+    return model
+def predict_intent(model, context):
+    """Return (classification, probability) for the most likely label. The probability is 0.0 when the email
+    has too few known features to tell, so no threshold trusts a label that only reflects the class priors."""
+    # Tokens never seen in training carry no evidence; scoring them would only favour the smallest class.
+    features = [token for token in intent_features(context)
+                if any(token in model["log_likelihoods"][label] for label in model["labels"])]
+    scores = {}
+    for label in model["labels"]:
+        likelihoods = model["log_likelihoods"][label]
+        unseen = model["unseen_log_likelihood"][label]
+        scores[label] = model["log_priors"][label] + sum(likelihoods.get(token, unseen) for token in features)
+    best = max(scores, key=scores.get)
+    if len(set(features)) < MIN_INTENT_KNOWN_FEATURES:
+        return best, 0.0
+    normalizer = sum(math.exp(score - scores[best]) for score in scores.values())
+    return best, 1 / normalizer
+def intent_accuracy_report(examples, folds=5, thresholds=(0.5, 0.6, 0.7, 0.8, 0.9, 0.95, 0.99)):
+    """Cross-validate the local model against LLM labels: coverage and accuracy at each confidence threshold."""
+    predictions = []
+    for fold in range(folds):
+        train = [example for i, example in enumerate(examples) if i % folds != fold]
+        test = [example for i, example in enumerate(examples) if i % folds == fold]
+        if not train or not test:
+            continue
+        model = train_intent_model(train)
+        for body, label in test:
+            predicted, confidence = predict_intent(model, body)
+            predictions.append((predicted == label, confidence))
+    report = {"examples": len(examples), "evaluated": len(predictions),
+              "accuracy": sum(correct for correct, _ in predictions) / len(predictions) if predictions else None,
+              "thresholds": []}
+    for threshold in thresholds:
+        covered = [correct for correct, confidence in predictions if confidence >= threshold]
+        report["thresholds"].append({
+            "threshold": threshold,
+            "coverage": len(covered) / len(predictions) if predictions else 0.0,
+            "accuracy": sum(covered) / len(covered) if covered else None
+        })
+    return report
+def load_intent_training_examples():
+    conn = email_store_connect()
+    try:
+        rows = conn.execute(f"""
+            SELECT body, initial_classification FROM processed_emails
+            WHERE body IS NOT NULL AND COALESCE(classification_source, 'llm') = 'llm'
+              AND initial_classification IN ({','.join('?' * len(INTENT_LABELS))})
+            ORDER BY message_id
+        """, INTENT_LABELS).fetchall()
+    finally:
+        conn.close()
+    return [(body, label) for body, label in rows]
+def retrain_intent_model():
+    """Retrain the local classifier from stored LLM labels, save it, and return the accuracy report."""
+    examples = load_intent_training_examples()
+    if len(examples) < MIN_INTENT_TRAINING_EXAMPLES or len({label for _, label in examples}) < 2:
+        raise ValueError(f"Need at least {MIN_INTENT_TRAINING_EXAMPLES} LLM-labelled emails across two or more "
+                         f"classifications to train; found {len(examples)}.")
+    report = intent_accuracy_report(examples)
+    model = train_intent_model(examples)
+    model["report"] = report
+    tmp_path = INTENT_MODEL_PATH + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(model, f)
+    os.replace(tmp_path, INTENT_MODEL_PATH)
+    return report
+@st.cache_resource
+def load_intent_model(path, mtime):
+    with open(path, "r") as f:
+        return json.load(f)
+def current_intent_model():
+    try:
+        return load_intent_model(INTENT_MODEL_PATH, os.path.getmtime(INTENT_MODEL_PATH))
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+def format_intent_report(report):
+    lines = [f"Examples: {report['examples']} | cross-validated accuracy: "
+             + (f"{report['accuracy']:.1%}" if report['accuracy'] is not None else "n/a"),
+             "threshold  coverage  accuracy"]
+    for row in report["thresholds"]:
+        accuracy = f"{row['accuracy']:.1%}" if row['accuracy'] is not None else "n/a"
+        lines.append(f"{row['threshold']:>9.2f}  {row['coverage']:>8.1%}  {accuracy:>8}")
+    return "\n".join(lines)
+def classify_email_intent_llm(context):
     prompt = f"""
     You are an email classification assistant specialized in analyzing supplier/business emails.
     EMAIL CONTENT TO ANALYZE:
     {context}
     Your task is to classify this email into ONE of these three categories:
-    1. "New Business Connection" - If the email is:
-       - Introduction email from new supplier
-       - Company introduction or capability presentation
-       - General business development outreach
-       - Marketing or promotional content
-       - Request for partnership or collaboration
-    2. "Quotation Received" - If the email contains ALL four essential elements:
-       - Product details
-       - Clear pricing information (unit price or total cost)
-       - Specific quantities mentioned
-       - Lead time or delivery information
-    3. "Quotation Partially Received" - If the email contains quotation elements but is missing ANY of these:
-       - Product details OR
-       - Unit price OR
-       - Quantities OR
-       - Lead time
+    {CLASSIFICATION_CATEGORIES}
     CLASSIFICATION RULES:
     - Focus on the PRIMARY intent of the email
     - Be specific and choose only ONE category
@@ -307,17 +1168,14 @@ def classify_email_intent(context):
     RESPOND WITH ONLY THE CLASSIFICATION CATEGORY NAME (exactly as written above):
     """
     try:
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.3,
-            max_tokens=50
-        )
-        classification = response.choices[0].message.content.strip()
+        response = llm_complete(prompt, temperature=0.3, max_tokens=50)
+        classification = response.strip()
         valid_classifications = ["Quotation Received", "Quotation Partially Received", "New Business Connection"]
         if classification not in valid_classifications:
             return "Unknown"
         return classification
+    except LLMError:
+        raise
     except Exception as e:
         return "Unknown"
 def extract_meeting_details(context):
@@ -326,18 +1184,7 @@ def extract_meeting_details(context):
     current_ist_iso = now_ist.isoformat()
     prompt = f"""
     You are an intelligent meeting scheduling assistant. Analyze the email below and determine:
-    1.Determine if the sender intends to set up a meeting. Reply with "Yes" or "No".
-    2. Is a specific date/time mentioned? If yes, convert to ISO 8601 format (IST).
-    3. If yes, infer the proposed date and time, even if partial (e.g., "6th at 4PM", "Monday morning").
-       - Convert into a full datetime string in ISO 8601 format (e.g., "2025-08-06T16:00:00+05:30").
-       - Assume Indian Standard Time (IST).
-       - If the date (e.g., "6th") has already passed this month, infer the next month.
-       - Use the provided current datetime to resolve relative references.
-    4. Who proposed the meeting time? Choose one:
-       - "sender": if the sender suggests a time (e.g., "Let's meet on 8th at 2 PM")
-       - "recipient": if the recipient (you) is asked to suggest a time (e.g., "Please let me know your availability")
-       - "mutual": if both parties are discussing options
-       - "none": if no time or intent
+    {MEETING_GUIDELINES}
     Email Content:
     {context}
     Current datetime (IST): {current_ist_iso}
@@ -347,13 +1194,8 @@ def extract_meeting_details(context):
     Source: sender/recipient/mutual/none
     """
     try:
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.3,
-            max_tokens=200
-        )
-        reply = response.choices[0].message.content.strip()
+        response = llm_complete(prompt, temperature=0.3, max_tokens=200, now=now_ist)
+        reply = response.strip()
         meeting_intent = "No"
         proposed_datetime = "Not specified"
         source = "none"
@@ -371,24 +1213,192 @@ def extract_meeting_details(context):
             "proposed_datetime": proposed_datetime,
             "source": source
         }
+    except LLMError:
+        raise
     except Exception as e:
         return {
             "meeting_intent": "No",
             "proposed_datetime": "Not specified",
             "source": "none"
         }
-def extract_quotation_data(context, classification):
-    if classification in ["New Business Connection", "Unknown"]:
-        business_qa_mapping = {
-            "What is the supplier's location, city, or place mentioned in the email signature?": "place",
-            "What is the sender's personal name mentioned in the email signature?": "sender_name",
-            "What is the company name mentioned in the email signature?": "company_name",
-            "What is the contact phone number mentioned in the email signature?": "contact_number",
-            "What is the sender's designation or job title mentioned in the email signature?": "designation"
+def _single_match(values, confidence):
+    """Confidence for a rule match: high when the email states exactly one distinct value."""
+    distinct = list(dict.fromkeys(values))
+    if not distinct:
+        return None
+    return distinct[0], confidence if len(distinct) == 1 else 0.5
+CURRENCY_SYMBOLS = {"rs": "₹", "rs.": "₹", "inr": "₹", "usd": "$", "us$": "$", "eur": "€", "gbp": "£"}
+def _clean_amount(amount):
+    """Normalize "Rs. 1,200" style amounts to the "₹1200" format the extraction guidelines ask for."""
+    symbol, number = re.match(r'(' + CURRENCY_PATTERN + r')\s?(.*)', amount, re.IGNORECASE).groups()
+    return CURRENCY_SYMBOLS.get(symbol.lower(), symbol) + number.replace(',', '')
+def rule_extract_fields(context):
+    """Resolve regularly formatted fields locally. Returns {key: (value, confidence)} for fields that matched."""
+    results = {}
+    per_unit = re.findall(r'(' + AMOUNT_PATTERN + r')\s*(?:/-)?\s*(?:/|per|a)\s*(?:piece|pc|unit|item|no\.?|nos|each|set|pair|kg)\b', context, re.IGNORECASE)
+    per_unit += re.findall(r'(' + AMOUNT_PATTERN + r')\s*(?:/-)?\s*each\b', context, re.IGNORECASE)
+    per_unit += re.findall(r'(?:unit\s*price|price\s*per\s*(?:piece|unit|item)|rate\s*per\s*(?:piece|unit))\s*(?:is|of|:|=|-)?\s*(' + AMOUNT_PATTERN + r')', context, re.IGNORECASE)
+    match = _single_match([_clean_amount(a) for a in per_unit], 0.9)
+    if match:
+        results["unit_price"] = match
+    totals = re.findall(r'(?:grand\s+)?total(?:\s+(?:cost|amount|price|value))?\s*(?:is|of|comes\s+to|:|=|-)?\s*(?:approx\.?\s*)?(' + AMOUNT_PATTERN + r')', context, re.IGNORECASE)
+    match = _single_match([_clean_amount(a) for a in totals], 0.9)
+    if match:
+        results["total_cost"] = match
+    quantities = [f"{number.replace(',', '')} {unit}" for number, unit in re.findall(
+        r'(?<![\d.,₹$€£])(\d[\d,]*)\s*(' + QUANTITY_UNITS + r')(?![a-z])', context, re.IGNORECASE)]
+    quantities += [f"{number.replace(',', '')} units" for number in re.findall(
+        r'\b(?:quantity|qty)\.?\s*(?:of|:|=|-)?\s*(\d[\d,]*)\b(?!\s*' + QUANTITY_UNITS + ')', context, re.IGNORECASE)]
+    match = _single_match(quantities, 0.9)
+    if match:
+        results["quantity"] = match
+    lead_times = []
+    for low, high, unit in re.findall(
+            r'(?:lead\s*time|delivery(?:\s*time)?|shipping\s*time|ready\s*in|available\s*in|dispatch(?:ed)?\s*(?:in|within))'
+            r'[^\d\n]{0,25}?(\d+)(?:\s*(?:-|–|to)\s*(\d+))?\s*(?:working\s+|business\s+)?(days?|weeks?|months?)\b',
+            context, re.IGNORECASE):
+        factor = LEAD_TIME_UNIT_DAYS[unit.lower().rstrip('s')]
+        days = f"{int(low) * factor}-{int(high) * factor}" if high else str(int(low) * factor)
+        lead_times.append(f"{days} days")
+    match = _single_match(lead_times, 0.9)
+    if match:
+        results["lead_time"] = match
+    phones = []
+    labelled = True
+    for candidate in re.finditer(r'(?<![\w+])(\+?\d[\d \t\-()]{8,}\d)(?!\w)', context):
+        number = candidate.group(1)
+        digits = re.sub(r'\D', '', number)
+        # Dates and times ("2025-08-12 11", "12-08-2025 10") have the same shape as a spaced phone number.
+        if not 10 <= len(digits) <= 13 or re.search(r'\d{4}-\d{1,2}-\d{1,2}|\d{1,2}[-/]\d{1,2}[-/]\d{2,4}', number):
+            continue
+        phones.append(re.sub(r'\s+', ' ', number.strip()))
+        # Without a + prefix or a phone label it could just as well be an order, invoice or reference number.
+        labelled = labelled and (number.startswith('+') or bool(re.search(
+            PHONE_LABEL_PATTERN, context[max(candidate.start() - 20, 0):candidate.start()], re.IGNORECASE)))
+    match = _single_match(phones, 0.9 if labelled else 0.6)
+    if match:
+        results["contact_number"] = match
+    return results
+@st.cache_resource
+def extraction_metrics():
+    return {"fields_total": 0, "fields_local": 0, "emails": 0, "emails_without_llm": 0, "per_field": {},
+            "lock": threading.Lock()}
+def record_extraction_metrics(field_keys, local_keys):
+    metrics = extraction_metrics()
+    with metrics["lock"]:
+        metrics["emails"] += 1
+        metrics["fields_total"] += len(field_keys)
+        metrics["fields_local"] += len(local_keys)
+        if len(local_keys) == len(field_keys):
+            metrics["emails_without_llm"] += 1
+        for key in field_keys:
+            local, total = metrics["per_field"].get(key, (0, 0))
+            metrics["per_field"][key] = (local + (key in local_keys), total + 1)
+def rule_resolved_fields(context, field_mapping):
+    """Fields of field_mapping the rules resolve confidently; also updates the extraction metrics."""
+    local_values = {
+        key: value for key, (value, confidence) in rule_extract_fields(context).items()
+        if key in field_mapping.values() and confidence >= RULE_CONFIDENCE_THRESHOLD
+    }
+    record_extraction_metrics(list(field_mapping.values()), list(local_values))
+    return local_values
+def no_meeting_details():
+    return {
+        "meeting_intent": "No",
+        "proposed_datetime": "Not specified",
+        "source": "none"
+    }
+def analyze_email_fused(context):
+    """Classification, meeting details and quotation fields from a single structured request.
+    Returns (initial_classification, classification_source, meeting_details, quotation_data); raises on failure."""
+    classification = classify_email_intent_locally(context)
+    # A trusted local label fixes the field set up front; otherwise ask for every field the LLM's label might need.
+    requested_mapping = business_qa_mapping if classification == "New Business Connection" else qa_mapping
+    local_values = rule_resolved_fields(context, requested_mapping)
+    remaining = {question: key for question, key in requested_mapping.items() if key not in local_values}
+    properties = {
+        "meeting_intent": {"type": "string", "enum": ["Yes", "No"]},
+        "proposed_datetime": {"type": "string", "description": "ISO 8601 timestamp in IST, or Not specified"},
+        "meeting_source": {"type": "string", "enum": ["sender", "recipient", "mutual", "none"]}
+    }
+    if remaining:
+        properties["quotation"] = {
+            "type": "object",
+            "properties": {key: {"type": "string", "description": question} for question, key in remaining.items()},
+            "required": list(remaining.values()),
+            "additionalProperties": False
         }
-        return {key: ask_openai(question, context) for question, key in business_qa_mapping.items()}
+    if classification is None:
+        properties["classification"] = {"type": "string", "enum": INTENT_LABELS}
+    schema = {"type": "object", "properties": properties, "required": list(properties), "additionalProperties": False}
+    questions = "\n".join(f'    - "{key}": {question}' for question, key in remaining.items()) or "    (none)"
+    ist = pytz.timezone('Asia/Kolkata')
+    now_ist = datetime.now(ist)
+    classification_task = f"""
+    TASK 1 - CLASSIFICATION ("classification"): classify this email into ONE of these three categories:
+    {CLASSIFICATION_CATEGORIES}
+    - Focus on the PRIMARY intent of the email
+    - Meeting requests are detected separately (not as a classification)""" if classification is None else ""
+    prompt = f"""
+    You are a specialized Purchase Order (PO) and supplier quotation assistant. Analyze the supplier email below once and return every requested item in a single JSON object.
+    EMAIL CONTENT TO ANALYZE:
+    {context}
+    Current datetime (IST): {now_ist.isoformat()}
+    {classification_task}
+    TASK 2 - MEETING ("meeting_intent", "proposed_datetime", "meeting_source"):
+    {MEETING_GUIDELINES}
+    TASK 3 - QUOTATION FIELDS ("quotation"; answer each question under its key):
+{questions}
+    {EXTRACTION_GUIDELINES}
+    RESPONSE RULES:
+    - Extract ONLY explicitly stated info.
+    - These responses are fed into a tabular format. So, for each key just return what is asked for.
+    - Do not hallucinate or take from the examples given above in this prompt
+    - If a quotation value is not found, use "Not present" for that key
+    - If no meeting time is given, use "Not specified" for proposed_datetime
+    - Don't assume or guess, only state exact extracted values
+    """
+    response = llm_complete(
+        prompt,
+        temperature=0.3,
+        max_tokens=250 + 60 * len(remaining),
+        response_format={
+            "type": "json_schema",
+            "json_schema": {"name": "email_analysis", "strict": True, "schema": schema}
+        },
+        now=now_ist
+    )
+    analysis = json.loads(response)
+    if classification is None:
+        classification, classification_source = analysis["classification"], "llm"
     else:
-        return {key: ask_openai(question, context) for question, key in qa_mapping.items()}
+        classification_source = "local"
+    meeting_details = {
+        "meeting_intent": analysis["meeting_intent"],
+        "proposed_datetime": analysis["proposed_datetime"].strip() or "Not specified",
+        "source": analysis["meeting_source"]
+    }
+    extracted = {key: normalize_extracted_value(value) for key, value in analysis.get("quotation", {}).items()}
+    field_mapping = business_qa_mapping if classification == "New Business Connection" else qa_mapping
+    quotation_data = {
+        key: local_values[key] if key in local_values else extracted.get(key, "Not present")
+        for key in field_mapping.values()
+    }
+    return classification, classification_source, meeting_details, quotation_data
+def extract_quotation_data(context, classification, structured=STRUCTURED_EXTRACTION):
+    if classification in ["New Business Connection", "Unknown"]:
+        field_mapping = business_qa_mapping
+    else:
+        field_mapping = qa_mapping
+    local_values = rule_resolved_fields(context, field_mapping)
+    remaining = {question: key for question, key in field_mapping.items() if key not in local_values}
+    if not remaining:
+        llm_values = {}
+    elif structured:
+        llm_values = ask_openai_structured(remaining, context)
+    else:
+        llm_values = {key: ask_openai(question, context) for question, key in remaining.items()}
+    return {key: local_values[key] if key in local_values else llm_values[key] for key in field_mapping.values()}
 def get_final_classification(quotation_data, initial_classification):
     if initial_classification in ["New Business Connection", "Unknown"]:
         return initial_classification
@@ -397,39 +1407,85 @@ def get_final_classification(quotation_data, initial_classification):
     if missing_fields:
         return "Quotation Partially Received"
     return "Quotation Received"
-def calculate_unit_price_if_missing(quotation_data):
-    if quotation_data.get("quantity", "Not present") == "Not present":
-        return quotation_data
-    unit_cost = quotation_data.get("unit_price", "Not present")
-    total_cost = quotation_data.get("total_cost", "Not present")
-    units = quotation_data.get("quantity", "Not present")
-    if unit_cost == "Not present" and total_cost != "Not present":
-        try:
-            total_num = float(''.join([c for c in total_cost if c.isdigit() or c == '.']))
-            quantity_num = float(''.join([c for c in units if c.isdigit() or c == '.']))
-            currency_symbol = ''.join([c for c in total_cost if not (c.isdigit() or c == '.' or c.isspace())])
-            if quantity_num > 0:
-                unit_price_calculated = total_num / quantity_num
-                quotation_data["unit_price"] = f"{currency_symbol}{unit_price_calculated:.2f}"
-        except Exception:
-            pass
-    return quotation_data
-def calculate_total_cost_if_missing(quotation_data):
-    if quotation_data.get("quantity", "Not present") == "Not present":
-        return quotation_data
-    unit_cost = quotation_data.get("unit_price", "Not present")
-    total_cost = quotation_data.get("total_cost", "Not present")
-    units = quotation_data.get("quantity", "Not present")
-    if total_cost == "Not present" and unit_cost != "Not present":
-        try:
-            unit_price_num = float(''.join([c for c in unit_cost if c.isdigit() or c == '.']))
-            quantity_num = float(''.join([c for c in units if c.isdigit() or c == '.']))
-            currency_symbol = ''.join([c for c in unit_cost if not (c.isdigit() or c == '.' or c.isspace())])
-            total_cost = f"{currency_symbol}{unit_price_num * quantity_num:.2f}"
-            quotation_data["total_cost"] = total_cost
-        except Exception:
-            pass
-    return quotation_data
+def _parse_number(text):
+    try:
+        return Decimal(text.replace(',', ''))
+    except InvalidOperation:
+        return None
+def parse_price(value):
+    """Parse "Rs. 1,275.00/-" style prices into (Decimal amount, ISO currency code); either may be None."""
+    match = re.search(r'(' + CURRENCY_PATTERN + r')?\s?(\d[\d,]*(?:\.\d+)?)', value or "", re.IGNORECASE)
+    if not match:
+        return None, None
+    symbol = match.group(1) or (re.search(CURRENCY_PATTERN, value, re.IGNORECASE) or [None])[0]
+    return _parse_number(match.group(2)), CURRENCY_CODES.get(symbol.lower()) if symbol else None
+def parse_quantity(value):
+    """Parse "1,000 pieces" style quantities into (Decimal number, unit); either may be None."""
+    match = re.search(r'(\d[\d,]*(?:\.\d+)?)\s*([a-z]+\.?)?', value or "", re.IGNORECASE)
+    if not match:
+        return None, None
+    unit = (match.group(2) or "").lower()
+    return _parse_number(match.group(1)), QUANTITY_UNIT_NAMES.get(unit, QUANTITY_UNIT_NAMES.get(unit.rstrip('.')))
+def parse_lead_time(value):
+    """Parse "10-15 days" or "2 weeks" style lead times into (min_days, max_days); both None when absent."""
+    match = re.search(r'(\d+)(?:\s*(?:-|–|to)\s*(\d+))?\s*(?:working\s+|business\s+)?(days?|weeks?|months?)?',
+                      value or "", re.IGNORECASE)
+    if not match:
+        return None, None
+    factor = LEAD_TIME_UNIT_DAYS[match.group(3).lower().rstrip('s')] if match.group(3) else 1
+    low = int(match.group(1)) * factor
+    high = int(match.group(2)) * factor if match.group(2) else low
+    return min(low, high), max(low, high)
+def format_price(amount, currency):
+    symbol = CURRENCY_DISPLAY.get(currency, f"{currency} " if currency else "")
+    return f"{symbol}{amount.quantize(Decimal('0.01'))}"
+def normalize_quotations(quotations):
+    """Typed view of a batch of quotation_data dicts: Decimal amounts with ISO currency, quantity and unit, and
+    lead time in min/max days. Missing unit prices and total costs are derived column-wise from the others."""
+    import pandas as pd
+    df = pd.DataFrame([{key: qd.get(key, 'Not present') for key in QUOTE_FIELDS} for qd in quotations],
+                      columns=QUOTE_FIELDS)
+    def parsed(column, parser):
+        values = [parser(value) if value != 'Not present' else (None, None) for value in df[column]]
+        return pd.DataFrame(values, index=df.index, columns=[0, 1], dtype=object)
+    df[['unit_price_amount', 'unit_price_currency']] = parsed('unit_price', parse_price)
+    df[['total_cost_amount', 'total_cost_currency']] = parsed('total_cost', parse_price)
+    df[['quantity_value', 'quantity_unit']] = parsed('quantity', parse_quantity)
+    df[['lead_time_min_days', 'lead_time_max_days']] = parsed('lead_time', parse_lead_time)
+    has_quantity = df['quantity_value'].notna()
+    positive_quantity = has_quantity & (df['quantity_value'].where(has_quantity, Decimal(0)) > 0)
+    df['unit_price_derived'] = df['unit_price_amount'].isna() & df['total_cost_amount'].notna() & positive_quantity
+    rows = df['unit_price_derived']
+    df.loc[rows, 'unit_price_amount'] = df.loc[rows, 'total_cost_amount'] / df.loc[rows, 'quantity_value']
+    df.loc[rows, 'unit_price_currency'] = df.loc[rows, 'total_cost_currency']
+    df['total_cost_derived'] = df['total_cost_amount'].isna() & df['unit_price_amount'].notna() & has_quantity
+    rows = df['total_cost_derived']
+    df.loc[rows, 'total_cost_amount'] = df.loc[rows, 'unit_price_amount'] * df.loc[rows, 'quantity_value']
+    df.loc[rows, 'total_cost_currency'] = df.loc[rows, 'unit_price_currency']
+    return df
+def derive_missing_costs(quotations):
+    """Fill in a missing unit price or total cost from the other two fields, for a whole batch at once."""
+    df = normalize_quotations(quotations)
+    filled = []
+    for qd, row in zip(quotations, df.itertuples()):
+        qd = dict(qd)
+        if row.unit_price_derived:
+            qd["unit_price"] = format_price(row.unit_price_amount, row.unit_price_currency)
+        if row.total_cost_derived:
+            qd["total_cost"] = format_price(row.total_cost_amount, row.total_cost_currency)
+        filled.append(qd)
+    return filled
+def derive_batch_costs(emails):
+    """Derive missing costs for every quotation among emails in one pass, and reclassify the ones whose unit
+    price could be derived. Updates the emails in place and returns them."""
+    quotes = [email for email in emails
+              if email['final_classification'] in ["Quotation Received", "Quotation Partially Received"]]
+    if not quotes:
+        return emails
+    for email, quotation_data in zip(quotes, derive_missing_costs([email['quotation_data'] for email in quotes])):
+        email['quotation_data'] = quotation_data
+        email['final_classification'] = get_final_classification(quotation_data, email['final_classification'])
+    return emails
 def send_reply(service, thread_id, to_email, subject, body):
     message = MIMEText(body)
     message['to'] = to_email
@@ -439,28 +1495,84 @@ def send_reply(service, thread_id, to_email, subject, body):
         'raw': raw,
         'threadId': thread_id
     }
-    try:
-        sent = service.users().messages().send(userId="me", body=message).execute()
-        return True, f"Reply sent to {to_email}"
-    except Exception as e:
-        return False, f"Error sending reply: {e}"
+    for attempt in range(SEND_RETRIES + 1):
+        try:
+            service.users().messages().send(userId="me", body=message).execute(http=thread_http(service))
+            return True, f"Reply sent to {to_email}"
+        except Exception as e:
+            if attempt < SEND_RETRIES and is_retryable_http_error(e):
+                time.sleep(backoff_delay(attempt))
+                continue
+            return False, f"Error sending reply: {e}"
+def backoff_delay(attempt):
+    """Exponential backoff with full jitter."""
+    return random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt))
+@st.cache_resource
+def calendar_busy_cache():
+    return {"lock": threading.Lock(), "calendars": {}}
+def _parse_calendar_time(value):
+    return datetime.fromisoformat(value.replace('Z', '+00:00'))
+def _merge_intervals(intervals):
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+def fetch_busy_intervals(calendar_service, time_min, time_max):
+    response = calendar_service.freebusy().query(body={
+        "timeMin": time_min.isoformat(),
+        "timeMax": time_max.isoformat(),
+        "timeZone": "Asia/Kolkata",
+        "items": [{"id": "primary"}]
+    }).execute(http=thread_http(calendar_service))
+    busy = response['calendars']['primary'].get('busy', [])
+    return _merge_intervals(
+        (_parse_calendar_time(interval['start']), _parse_calendar_time(interval['end'])) for interval in busy
+    )
+def primary_calendar_id(calendar_service):
+    """Id of the account's primary calendar (its address), looked up once per service."""
+    if not hasattr(calendar_service, 'primary_calendar_id'):
+        calendar_service.primary_calendar_id = calendar_service.calendars().get(calendarId='primary').execute(
+            http=thread_http(calendar_service))['id']
+    return calendar_service.primary_calendar_id
+def busy_index(calendar_service, start_time, end_time):
+    """Return the cached, merged busy intervals covering [start_time, end_time], refreshing them when stale."""
+    cache = calendar_busy_cache()
+    calendar_id = primary_calendar_id(calendar_service)
+    with cache["lock"]:
+        entry = cache["calendars"].get(calendar_id)
+        if (entry is None or time.time() - entry["fetched_at"] > FREEBUSY_TTL_SECONDS
+                or start_time < entry["window"][0] or end_time > entry["window"][1]):
+            window_start = start_time.replace(hour=0, minute=0, second=0, microsecond=0)
+            window_end = max(end_time, window_start + timedelta(days=FREEBUSY_WINDOW_DAYS))
+            intervals = fetch_busy_intervals(calendar_service, window_start, window_end)
+            entry = {
+                "window": (window_start, window_end),
+                "intervals": intervals,
+                "starts": [start for start, _ in intervals],
+                "fetched_at": time.time()
+            }
+            cache["calendars"][calendar_id] = entry
+        return entry
+def add_busy_interval(calendar_service, start_time, end_time):
+    """Record an event we just inserted so later checks see it without refetching."""
+    cache = calendar_busy_cache()
+    calendar_id = primary_calendar_id(calendar_service)
+    with cache["lock"]:
+        entry = cache["calendars"].get(calendar_id)
+        if entry is None:
+            return
+        entry["intervals"] = _merge_intervals(entry["intervals"] + [(start_time, end_time)])
+        entry["starts"] = [start for start, _ in entry["intervals"]]
 def check_calendar_conflict(calendar_service, start_time, end_time):
     try:
-        events_result = calendar_service.events().list(
-            calendarId='primary',
-            timeMin=start_time.isoformat(),
-            timeMax=end_time.isoformat(),
-            singleEvents=True,
-            orderBy='startTime'
-        ).execute()
-        events = events_result.get('items', [])
-        for event in events:
-            event_start = datetime.fromisoformat(
-                event['start'].get('dateTime', event['start'].get('date')).replace('Z', '+00:00'))
-            event_end = datetime.fromisoformat(
-                event['end'].get('dateTime', event['end'].get('date')).replace('Z', '+00:00'))
-            if not (end_time <= event_start or start_time >= event_end):
-                return True, event.get('summary', 'Existing meeting')
+        entry = busy_index(calendar_service, start_time, end_time)
+        # Intervals are merged and sorted, so only the last one starting before end_time can overlap.
+        position = bisect.bisect_left(entry["starts"], end_time)
+        if position and entry["intervals"][position - 1][1] > start_time:
+            return True, 'Existing meeting'
         return False, None
     except Exception as e:
         print(f"Error checking calendar conflict: {e}")
@@ -526,38 +1638,201 @@ def schedule_meeting(calendar_service, quotation_data, email_address, proposed_d
                 ],
             },
         }
-        event = calendar_service.events().insert(calendarId='primary', body=event, sendUpdates='all').execute()
+        event = calendar_service.events().insert(calendarId='primary', body=event, sendUpdates='all').execute(
+            http=thread_http(calendar_service))
+        add_busy_interval(calendar_service, proposed_datetime, end_time)
         return event, "scheduled"
     except Exception as e:
         print(f"Error scheduling meeting: {e}")
         return None, "error"
-def parse_new_datetime(instructions, reference_datetime_str=None):
+def _parse_reference_datetime(reference_datetime_str):
+    try:
+        reference = datetime.fromisoformat(reference_datetime_str)
+    except (TypeError, ValueError):
+        return None
+    ist = pytz.timezone('Asia/Kolkata')
+    return reference.astimezone(ist) if reference.tzinfo else ist.localize(reference)
+def _resolve_time_phrases(text, reference):
+    """Return ([(hour, minute)], matched spans) for every time of day mentioned in text."""
+    times = []
+    spans = []
+    for match in re.finditer(r'\b(\d{1,2})(?::(\d{2}))?\s*([ap])\.?\s?m\b\.?', text):
+        hour, minute = int(match.group(1)), int(match.group(2) or 0)
+        if not 1 <= hour <= 12 or minute > 59:
+            return None, spans
+        times.append((hour % 12 + (12 if match.group(3) == 'p' else 0), minute))
+        spans.append(match.span())
+    for match in re.finditer(r'(?<![\d:])(\d{1,2}):(\d{2})(?![\d:])(?!\s*[ap]\.?\s?m\b)', text):
+        hour, minute = int(match.group(1)), int(match.group(2))
+        if hour > 23 or minute > 59:
+            return None, spans
+        # Without am/pm, 1-7 o'clock means the afternoon within business hours.
+        times.append((hour + 12 if 1 <= hour <= 7 else hour, minute))
+        spans.append(match.span())
+    if re.search(r'\bsame\s+time\b', text):
+        if reference is None:
+            return None, spans
+        times.append((reference.hour, reference.minute))
+        spans.append(re.search(r'\bsame\s+time\b', text).span())
+    if not times:
+        for word, value in TIME_OF_DAY.items():
+            match = re.search(r'\b' + word + r'\b', text)
+            if match:
+                times.append(value)
+                spans.append(match.span())
+    return times, spans
+def _resolve_date_phrases(text, now, reference):
+    """Return ([date], matched spans) for every calendar day mentioned in text."""
+    dates = []
+    spans = []
+    today = now.date()
+    def add(value, span):
+        dates.append(value)
+        spans.append(span)
+    for match in re.finditer(r'\bday\s+after\s+tomorrow\b', text):
+        add(today + timedelta(days=2), match.span())
+    for match in re.finditer(r'(?<!after\s)\btomorrow\b', text):
+        add(today + timedelta(days=1), match.span())
+    for match in re.finditer(r'\btoday\b', text):
+        add(today, match.span())
+    for match in re.finditer(r'\bin\s+(\d{1,2})\s+days?\b', text):
+        add(today + timedelta(days=int(match.group(1))), match.span())
+    for match in re.finditer(r'\bsame\s+day\b', text):
+        if reference is None:
+            return None, spans
+        add(reference.date(), match.span())
+    for match in re.finditer(r'\b(?:(?:next|this|coming)\s+)?(' + '|'.join(WEEKDAY_NUMBERS) + r')\b', text):
+        days_ahead = (WEEKDAY_NUMBERS[match.group(1)] - today.weekday()) % 7 or 7
+        add(today + timedelta(days=days_ahead), match.span())
+    month_names = r'(jan|feb|mar|apr|may|jun|jul|aug|sep|oct|nov|dec)[a-z]*\.?'
+    day_month = r'\b(\d{1,2})(?:st|nd|rd|th)?\s+(?:of\s+)?' + month_names + r'(?![a-z])'
+    month_day = r'\b' + month_names + r'\s+(\d{1,2})(?:st|nd|rd|th)?\b'
+    for pattern, day_group, month_group in ((day_month, 1, 2), (month_day, 2, 1)):
+        for match in re.finditer(pattern, text):
+            try:
+                value = datetime(today.year, MONTH_NUMBERS[match.group(month_group)], int(match.group(day_group))).date()
+                if value < today:
+                    value = value.replace(year=today.year + 1)
+            except ValueError:
+                return None, spans
+            add(value, match.span())
+    taken = list(spans)
+    for match in re.finditer(r'\b(\d{1,2})(?:st|nd|rd|th)\b', text):
+        if any(start <= match.start() < end for start, end in taken):
+            continue
+        # A bare ordinal that has already passed this month means next month.
+        year, month = today.year, today.month
+        if int(match.group(1)) < today.day:
+            year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+        try:
+            add(datetime(year, month, int(match.group(1))).date(), match.span())
+        except ValueError:
+            return None, spans
+    return dates, spans
+def resolve_datetime_locally(text, now=None, reference_datetime_str=None):
+    """Resolve phrases like "6th at 4PM", "Monday morning" or "same day at 2:30" to an IST datetime.
+    Returns (datetime, matched spans), or (None, spans) when the phrase is missing, incomplete or ambiguous."""
+    ist = pytz.timezone('Asia/Kolkata')
+    now = now or datetime.now(ist)
+    text = text.lower()
+    iso = re.search(r'\b\d{4}-\d{2}-\d{2}t\d{2}:\d{2}(?::\d{2})?(?:[+-]\d{2}:\d{2}|z)?', text)
+    if iso:
+        value = datetime.fromisoformat(iso.group(0).upper().replace('Z', '+00:00'))
+        return (value.astimezone(ist) if value.tzinfo else ist.localize(value)), [iso.span()]
+    reference = _parse_reference_datetime(reference_datetime_str)
+    dates, date_spans = _resolve_date_phrases(text, now, reference)
+    times, time_spans = _resolve_time_phrases(text, reference)
+    spans = date_spans + time_spans
+    if not dates or not times or len(set(dates)) != 1 or len(set(times)) != 1:
+        return None, spans
+    (hour, minute), day = times[0], dates[0]
+    return ist.localize(datetime(day.year, day.month, day.day, hour, minute)), spans
+def interpret_instructions_locally(instructions, reference_datetime_str=None, now=None):
+    """Handle short instructions that are only a datetime plus a clear schedule/propose verb without the LLM."""
+    lowered = instructions.lower()
+    resolved, spans = resolve_datetime_locally(lowered, now, reference_datetime_str)
+    schedule = re.search(SCHEDULE_WORDS, lowered)
+    propose = re.search(PROPOSE_WORDS, lowered)
+    if resolved is None or bool(schedule) == bool(propose) or 'confirm' in lowered:
+        return None
+    spans += [match.span() for pattern in (SCHEDULE_WORDS, PROPOSE_WORDS) for match in re.finditer(pattern, lowered)]
+    leftover = ''.join(' ' if any(start <= i < end for start, end in spans) else char for i, char in enumerate(lowered))
+    if set(re.findall(r'[a-z]+', leftover)) - INSTRUCTION_FILLER:
+        # Anything else in the text may be a directive for the reply, which needs the LLM.
+        return None
+    return {"datetime": resolved.isoformat(), "intent": "SCHEDULE" if schedule else "PROPOSE", "directives": []}
+def interpret_instructions(instructions, reference_datetime_str=None):
+    """Interpret the Instructions cell once: meeting datetime, schedule/propose intent and any other directives.
+    Blank instructions need no request; results are cached per instruction text, reference datetime and day."""
+    if not instructions or not instructions.strip():
+        return {"datetime": "Not specified", "intent": "NEUTRAL", "directives": []}
+    local = interpret_instructions_locally(instructions, reference_datetime_str)
+    if local:
+        return local
+    ist = pytz.timezone('Asia/Kolkata')
+    try:
+        return _interpret_instructions_cached(instructions.strip(), reference_datetime_str,
+                                              datetime.now(ist).strftime('%Y-%m-%d'))
+    except LLMError:
+        raise
+    except Exception as e:
+        # Not cached: the next send asks again instead of reusing the uninterpreted result all day.
+        logger.warning(f"Instruction interpretation error: {e}")
+        return {"datetime": "Not specified", "intent": "NEUTRAL", "directives": []}
+@st.cache_data(max_entries=1000, show_spinner=False)
+def _interpret_instructions_cached(instructions, reference_datetime_str, today):
+    """The LLM interpretation of instructions; raises on failure so that st.cache_data keeps only good results."""
     ist = pytz.timezone('Asia/Kolkata')
     now = datetime.now(ist)
-    current_iso = now.isoformat()
     prompt = f"""
-You are a smart datetime parser. Your task is to extract a full meeting datetime from the user's instructions.
+You are a smart assistant that interprets a user's instructions for replying to a supplier email.
 Instructions: "{instructions}"
-Current datetime (IST): {current_iso}
+Current datetime (IST): {now.isoformat()}
 Reference datetime (if mentioned earlier in the email): {reference_datetime_str or "None"}
-Rules:
-- If the instruction says "same day", assume it refers to the reference datetime.
-- Return the extracted datetime in **ISO 8601 format**, e.g., "2025-09-08T16:30:00+05:30"
-- Assume all times are in Indian Standard Time (IST).
-- If the datetime is vague or incomplete and you can't resolve it even with reference, return "Not specified".
-- Do NOT explain — just return the datetime or "Not specified".
-Answer:
+Return a JSON object with:
+1. "datetime": the full meeting datetime the instructions ask for.
+   - If the instruction says "same day", assume it refers to the reference datetime.
+   - Return the extracted datetime in ISO 8601 format, e.g., "2025-09-08T16:30:00+05:30"
+   - Assume all times are in Indian Standard Time (IST).
+   - If the datetime is vague or incomplete and you can't resolve it even with reference, return "Not specified".
+2. "intent": one of
+   - "SCHEDULE" if the instructions clearly indicate to book/schedule now
+   - "PROPOSE" if the instructions suggest a time but need confirmation
+   - "NEUTRAL" if unclear
+   Considerations:
+   - Look for imperative verbs (schedule, book, confirm, proceed, set up, finalized)
+   - Look for tentative language (could we, would you, please confirm, check, suggest, whether, okay, work for you)
+   - Instructions implying meeting preparation (e.g., "bring a flyer", "prepare a presentation", "come with documents") indicate acceptance of the meeting and should be treated as "SCHEDULE"
+   - Ignore greetings and pleasantries
+   - Focus on the action intent
+3. "directives": any other requests for the reply that are not about the meeting time (e.g., "ask for a sample", "request GST details"), each as a short phrase. Use an empty list if there are none.
 """
-    try:
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.1,
-            max_tokens=50
-        )
-        return response.choices[0].message.content.strip()
-    except Exception as e:
-        return "Not specified"
+    response = llm_complete(
+        prompt,
+        temperature=0.1,
+        max_tokens=200,
+        response_format={
+            "type": "json_schema",
+            "json_schema": {"name": "instruction_interpretation", "strict": True, "schema": {
+                "type": "object",
+                "properties": {
+                    "datetime": {"type": "string"},
+                    "intent": {"type": "string", "enum": ["SCHEDULE", "PROPOSE", "NEUTRAL"]},
+                    "directives": {"type": "array", "items": {"type": "string"}}
+                },
+                "required": ["datetime", "intent", "directives"],
+                "additionalProperties": False
+            }}
+        },
+        now=now
+    )
+    interpretation = json.loads(response)
+    interpretation["datetime"] = interpretation["datetime"].strip() or "Not specified"
+    # Prefer the deterministic resolver's datetime whenever it can read the phrase.
+    resolved, _ = resolve_datetime_locally(instructions, now, reference_datetime_str)
+    if resolved:
+        interpretation["datetime"] = resolved.isoformat()
+    return interpretation
 def get_meeting_date_time(meeting_details):
     if not meeting_details or meeting_details.get("meeting_intent") != "Yes":
         return "Not Requested", "Not Requested"
@@ -570,46 +1845,8 @@ def get_meeting_date_time(meeting_details):
         return date_str, time_str
     except:
         return "Not Specified", "Not Specified"
-def should_schedule_from_instructions(instructions):
-    """Determine if instructions indicate to schedule a meeting using LLM analysis."""
-    if not instructions.strip():
-        return False
-    prompt = f"""
-    Analyze the following meeting scheduling instructions and determine if the user intends to:
-    1. CONFIRM/SCHEDULE - The user wants to definitively schedule the meeting now
-    2. PROPOSE/CHECK - The user is suggesting a time but wants confirmation
-    3. NEUTRAL - The instructions are unclear
-    Instructions: "{instructions}"
-    Respond ONLY with one of these three words:
-    - "SCHEDULE" if the instructions clearly indicate to book/schedule now
-    - "PROPOSE" if the instructions suggest a time but need confirmation
-    - "NEUTRAL" if unclear
-    Considerations:
-    - Look for imperative verbs (schedule, book, confirm, proceed, set up, finalized)
-    - Look for tentative language (could we, would you, please confirm, check, suggest, whether, okay, work for you)
-    - Instructions implying meeting preparation (e.g., "bring a flyer", "prepare a presentation", "come with documents") indicate acceptance of the meeting and should be treated as "SCHEDULE"
-    - Ignore greetings and pleasantries
-    - Focus on the action intent
-    """
-    try:
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.1,
-            max_tokens=10
-        )
-        decision = response.choices[0].message.content.strip().upper()
-        if "SCHEDULE" in decision:
-            return True
-        elif "PROPOSE" in decision:
-            return False
-        else:  # NEUTRAL or any other response
-            return False
-    except Exception as e:
-        print(f"LLM scheduling decision error: {e}")
-        return False  # Fallback to not scheduling
 def get_reply_body(classification, quotation_data, sender_name, meeting_details=None, meeting_result=None,
-                   instructions=""):
+                   instructions="", directives=None):
     ist = pytz.timezone('Asia/Kolkata')
     # Construct base message
     if classification == "Quotation Received":
@@ -640,7 +1877,6 @@ Thank you for your email."""
     # Prepare for meeting-related handling
     meeting_text = ""
     try:
-        schedule_decision = should_schedule_from_instructions(instructions)
         sender_proposed = meeting_details and meeting_details.get("source") == "sender"
         meeting_intent = meeting_details and meeting_details.get("meeting_intent") == "Yes"
         should_add_meeting_text = instructions.strip() or meeting_intent
@@ -653,6 +1889,7 @@ Email Classification: {classification}
 Original Meeting Details: {meeting_details}
 Meeting Result: {meeting_result}
 Instructions from User: "{instructions}"
+{'Other requests to include in the reply: ' + '; '.join(directives) if directives else ''}
 Guidelines:
 1. Avoid redundant phrases like "Thank you for your quotation" if already in the base message.
 2. For meeting scheduling:
@@ -708,226 +1945,227 @@ BITSoM
 6. DO NOT hallucinate or give replies based on examples. Understand the essence and proceed.
 Respond ONLY with the text to be inserted in the email (no extra headings or markers).
 """
-            response = client.chat.completions.create(
-                model="gpt-4o",
-                messages=[{"role": "user", "content": prompt}],
-                temperature=0.1,
-                max_tokens=400
-            )
-            meeting_text = "\n" + response.choices[0].message.content.strip()
+            response = llm_complete(prompt, temperature=0.1, max_tokens=400)
+            meeting_text = "\n" + response.strip()
+    except LLMError:
+        raise
     except Exception as e:
         meeting_text = f"\nAdditional Instructions: {instructions}"
     return base_message + meeting_text
+def get_reply_draft(email_data, instructions="", drafts=None):
+    """Draft the reply for one email only when it is needed. Drafts are memoized per message and
+    regenerated when the instructions, classification or meeting result change."""
+    drafts = st.session_state.reply_drafts if drafts is None else drafts
+    meeting_result = email_data.get('meeting_result') or (None, None)
+    fingerprint = json.dumps([instructions.strip(), email_data['final_classification'], meeting_result],
+                             sort_keys=True, default=str)
+    cached = drafts.get(email_data['message_id'])
+    if cached and cached["fingerprint"] == fingerprint:
+        return cached["body"]
+    reference_datetime = (email_data.get('meeting_details') or {}).get("proposed_datetime")
+    body = get_reply_body(
+        email_data['final_classification'],
+        email_data['quotation_data'],
+        email_data['quotation_data'].get('sender_name'),
+        email_data.get('meeting_details'),
+        meeting_result,
+        instructions,
+        interpret_instructions(instructions, reference_datetime)["directives"]
+    )
+    drafts[email_data['message_id']] = {"fingerprint": fingerprint, "body": body}
+    return body
+MEETING_STATUS_LABELS = {
+    "scheduled": "Meeting Scheduled",
+    "conflict": "Schedule Conflict",
+    "outside_business_hours": "Outside Business Hours",
+    "past_time": "Time Already Passed",
+    "no_specific_time": "No Specific Time",
+    "incomplete_details": "Incomplete Details",
+    "parse_error": "Time Parse Error",
+    "proposed_for_confirmation": "Meeting Proposed for Confirmation"
+}
 def get_meeting_status(meeting_details, meeting_result):
     if not meeting_details or meeting_details.get("meeting_intent") != "Yes":
         return "No Meeting Requested"
     if meeting_result:
-        status = meeting_result[1]
-        if status == "scheduled":
-            return "Meeting Scheduled"
-        elif status == "conflict":
-            return "Schedule Conflict"
-        elif status == "outside_business_hours":
-            return "Outside Business Hours"
-        elif status == "past_time":
-            return "Time Already Passed"
-        elif status == "no_specific_time":
-            return "No Specific Time"
-        elif status == "incomplete_details":
-            return "Incomplete Details"
-        elif status == "parse_error":
-            return "Time Parse Error"
-        elif status == "proposed_for_confirmation":
-            return "Meeting Proposed for Confirmation"
-        else:
-            return "Error Occurred"
+        return MEETING_STATUS_LABELS.get(meeting_result[1], "Error Occurred")
     else:
         return "Meeting Requested"
-def create_quotation_received_table(emails):
-    if not emails:
-        return pd.DataFrame()
-    data = []
-    for email in emails:
-        qd = email['quotation_data']
-        meeting_status = get_meeting_status(email.get('meeting_details'), email.get('meeting_result'))
-        meeting_date, meeting_time = get_meeting_date_time(email.get('meeting_details'))
-        data.append({
-            'Sender Name': qd.get('sender_name', 'Not present'),
-            'Company': qd.get('company_name', 'Not present'),
-            'Email': email['email_address'],
-            'Product': qd.get('product', 'Not present').split(':')[-1].strip() if ':' in qd.get('product', 'Not present') else qd.get('product', 'Not present'),
-            'Quantity': qd.get('quantity', 'Not present'),
-            'Unit Price': qd.get('unit_price', 'Not present'),
-            'Total Cost': qd.get('total_cost', 'Not present'),
-            'Lead Time': qd.get('lead_time', 'Not present'),
-            'Location': qd.get('place', 'Not present'),
-            'Contact': qd.get('contact_number', 'Not present'),
-            'Designation': qd.get('designation', 'Not present'),  # Add designation
-            'Meeting Status': meeting_status,
-            'Date of Meeting': meeting_date,
-            'Time of Meeting': meeting_time,
-            'Instructions': '',
-            'Send': False
-        })
-    df = pd.DataFrame(data)
-    return df
-def create_quotation_partial_table(emails):
-    if not emails:
-        return pd.DataFrame()
-    data = []
-    for email in emails:
-        qd = email['quotation_data']
-        meeting_status = get_meeting_status(email.get('meeting_details'), email.get('meeting_result'))
-        meeting_date, meeting_time = get_meeting_date_time(email.get('meeting_details'))
-        missing_fields = []
-        if qd.get('product', 'Not present') == 'Not present':
-            missing_fields.append('Product')
-        if qd.get('quantity', 'Not present') == 'Not present':
-            missing_fields.append('Quantity')
-        if qd.get('unit_price', 'Not present') == 'Not present':
-            missing_fields.append('Unit Price')
-        if qd.get('lead_time', 'Not present') == 'Not present':
-            missing_fields.append('Lead Time')
-        data.append({
-            'Sender Name': qd.get('sender_name', 'Not present'),
-            'Company': qd.get('company_name', 'Not present'),
-            'Email': email['email_address'],
-            'Product': qd.get('product', 'Not present').split(':')[-1].strip() if ':' in qd.get('product', 'Not present') else qd.get('product', 'Not present'),
-            'Quantity': qd.get('quantity', 'Not present'),
-            'Unit Price': qd.get('unit_price', 'Not present'),
-            'Total Cost': qd.get('total_cost', 'Not present'),
-            'Lead Time': qd.get('lead_time', 'Not present'),
-            'Location': qd.get('place', 'Not present'),
-            'Contact': qd.get('contact_number', 'Not present'),
-            'Designation': qd.get('designation', 'Not present'),  # Add designation
-            'Missing Fields': ', '.join(missing_fields) if missing_fields else 'None',
-            'Meeting Status': meeting_status,
-            'Date of Meeting': meeting_date,
-            'Time of Meeting': meeting_time,
-            'Instructions': '',
-            'Send': False
-        })
-    df = pd.DataFrame(data)
-    return df
-def create_business_connection_table(emails):
-    if not emails:
-        return pd.DataFrame()
-    data = []
-    for email in emails:
-        qd = email['quotation_data']
-        meeting_status = get_meeting_status(email.get('meeting_details'), email.get('meeting_result'))
-        meeting_date, meeting_time = get_meeting_date_time(email.get('meeting_details'))
-        data.append({
-            'Sender Name': qd.get('sender_name', 'Not present'),
-            'Company': qd.get('company_name', 'Not present'),
-            'Email': email['email_address'],
-            'Designation': qd.get('designation', 'Not present'),
-            'Location': qd.get('place', 'Not present'),
-            'Contact': qd.get('contact_number', 'Not present'),
-            'Meeting Status': meeting_status,
-            'Date of Meeting': meeting_date,
-            'Time of Meeting': meeting_time,
-            'Instructions': '',
-            'Send': False
-        })
-    df = pd.DataFrame(data)
-    return df
-def send_replies_for_emails(service, calendar_service, emails, df):
-    success_count = 0
-    error_count = 0
-    selected_emails = [(email, row) for email, row in zip(emails, df.itertuples(index=False)) if getattr(row, 'Send')]
-    if not selected_emails:
-        st.warning("No emails selected to send replies.")
-        return
-    progress_bar = st.progress(0)
-    status_text = st.empty()
-    for i, (email_data, row) in enumerate(selected_emails):
-        progress = (i + 1) / len(selected_emails)
-        progress_bar.progress(progress)
-        status_text.text(f'Sending reply {i + 1} of {len(selected_emails)}...')
-        instructions = getattr(row, 'Instructions', '')
-        meeting_details = email_data.get('meeting_details', {})
-        meeting_result = email_data.get('meeting_result', (None, None))
-        if not isinstance(meeting_result, (tuple, list)) or len(meeting_result) < 2:
-            meeting_result = (None, None)
-        if meeting_details.get('meeting_intent') == "Yes":
-            current_status = meeting_result[1]
-            ist = pytz.timezone('Asia/Kolkata')
-            try:
-                # Check instructions FIRST for new time or intent
-                reference_datetime = meeting_details.get("proposed_datetime", None)
-                new_time_str = parse_new_datetime(instructions, reference_datetime)
-                should_schedule = should_schedule_from_instructions(instructions)
-                if instructions.strip() and new_time_str != "Not specified":
+# Unit Price, Total Cost and Lead Days are numeric so the tables sort by value; Lead Time keeps the supplier's wording.
+QUOTATION_TABLE_COLUMNS = ['Sender Name', 'Company', 'Email', 'Product', 'Quantity', 'Unit Price', 'Total Cost',
+                           'Currency', 'Lead Time', 'Lead Days', 'Location', 'Contact', 'Designation', 'Meeting Status',
+                           'Date of Meeting', 'Time of Meeting', 'Instructions', 'Send']
+PARTIAL_TABLE_COLUMNS = QUOTATION_TABLE_COLUMNS[:13] + ['Missing Fields'] + QUOTATION_TABLE_COLUMNS[13:]
+BUSINESS_TABLE_COLUMNS = ['Sender Name', 'Company', 'Email', 'Designation', 'Location', 'Contact', 'Meeting Status',
+                          'Date of Meeting', 'Time of Meeting', 'Instructions', 'Send']
+def set_processed_emails(emails):
+    st.session_state.processed_emails = emails
+    st.session_state.data_version += 1
+def session_account():
+    """Address of the signed-in mailbox, looked up once per session."""
+    if not st.session_state.account:
+        st.session_state.account = st.session_state.gmail_service.users().getProfile(userId='me').execute(
+            http=thread_http(st.session_state.gmail_service))['emailAddress']
+    return st.session_state.account
+def reload_processed_emails():
+    account = session_account()
+    adopt_unowned_emails(account)
+    st.session_state.store_revision = email_store_revision(account)
+    set_processed_emails(load_processed_emails(account))
+    st.session_state.processed_emails_loaded = True
+@st.cache_data(max_entries=32, show_spinner=False)
+def build_master_table(session_id, data_version, _processed_emails):
+    """Every processed email as one columnar table, built once per (session, data version).
+    The per-classification views are slices of it."""
+    import pandas as pd
+    emails = _processed_emails
+    qd = pd.DataFrame.from_records(
+        [email['quotation_data'] for email in emails],
+        columns=QUOTE_FIELDS + ["place", "sender_name", "company_name", "contact_number", "designation"]
+    ).fillna('Not present')
+    details = [email.get('meeting_details') or {} for email in emails]
+    requested = pd.Series([d.get("meeting_intent") == "Yes" for d in details], dtype=bool)
+    results = pd.Series([email['meeting_result'][1] if email.get('meeting_result') else None for email in emails],
+                        dtype=object)
+    has_result = pd.Series([bool(email.get('meeting_result')) for email in emails], dtype=bool)
+    meeting_status = (results.map(MEETING_STATUS_LABELS).fillna("Error Occurred")
+                      .where(has_result, "Meeting Requested").where(requested, "No Meeting Requested"))
+    proposed = pd.Series([d.get("proposed_datetime") for d in details], dtype=object)
+    parts = proposed.str.extract(r'^(\d{4}-\d{2}-\d{2})(?:[T ](\d{2}:\d{2}))?')
+    meeting_time = parts[1].where(parts[1].notna(), parts[0].where(parts[0].isna(), "00:00"))
+    # get_meeting_date_time semantics: unparseable times read "Not Specified", no request reads "Not Requested".
+    meeting_date = parts[0].fillna("Not Specified").where(requested, "Not Requested").astype(str)
+    meeting_time = meeting_time.fillna("Not Specified").where(requested, "Not Requested").astype(str)
+    normalized = normalize_quotations([email['quotation_data'] for email in emails])
+    missing = qd[REQUIRED_QUOTE_FIELDS].eq('Not present')
+    missing_fields = missing.dot(pd.Index([field.replace('_', ' ').title() + ', ' for field in REQUIRED_QUOTE_FIELDS]))
+    missing_fields = missing_fields.str.rstrip(', ')
+    master = pd.DataFrame({
+        'Classification': [email['final_classification'] for email in emails],
+        'Sender Name': qd['sender_name'],
+        'Company': qd['company_name'],
+        'Email': [email['email_address'] for email in emails],
+        'Product': qd['product'].str.split(':').str[-1].str.strip(),
+        'Quantity': qd['quantity'],
+        'Unit Price': pd.to_numeric(normalized['unit_price_amount'], errors='coerce'),
+        'Total Cost': pd.to_numeric(normalized['total_cost_amount'], errors='coerce'),
+        'Currency': normalized['unit_price_currency'].fillna(normalized['total_cost_currency']).fillna(''),
+        'Lead Time': qd['lead_time'],
+        'Lead Days': pd.to_numeric(normalized['lead_time_max_days'], errors='coerce'),
+        'Location': qd['place'],
+        'Contact': qd['contact_number'],
+        'Designation': qd['designation'],
+        'Missing Fields': missing_fields.where(missing_fields != '', 'None'),
+        'Meeting Status': meeting_status,
+        'Date of Meeting': meeting_date,
+        'Time of Meeting': meeting_time,
+        'Instructions': '',
+        'Send': False
+    })
+    return master.infer_objects()
+def table_view(master, processed_emails, classification, columns):
+    """Slice the master table for one classification. Returns (emails, DataFrame) with matching row order."""
+    rows = master[master['Classification'] == classification]
+    return [processed_emails[i] for i in rows.index], rows[columns].reset_index(drop=True)
+@st.cache_data(max_entries=32, show_spinner=False)
+def _cached_table_csv(session_id, data_version, view, _df):
+    return _df.to_csv(index=False)
+def table_csv(view, base_df, edited_df):
+    """CSV for a table view; unedited tables reuse the serialization cached for this data version."""
+    if edited_df.equals(base_df):
+        return _cached_table_csv(st.session_state.table_session_id, st.session_state.data_version, view, base_df)
+    return edited_df.to_csv(index=False)
+def scheduled_start(event):
+    """Start of a Calendar event returned by schedule_meeting, or None."""
+    try:
+        return datetime.fromisoformat(event['start']['dateTime'])
+    except (KeyError, TypeError, ValueError):
+        return None
+def resolve_meeting_for_reply(calendar_service, email_data, instructions, scheduling_lock):
+    """Apply the row's instructions to the email's meeting request before replying.
+    Updates email_data['meeting_result'] and returns an error message, or None."""
+    meeting_details = email_data.get('meeting_details') or {}
+    meeting_result = email_data.get('meeting_result', (None, None))
+    if not isinstance(meeting_result, (tuple, list)) or len(meeting_result) < 2:
+        meeting_result = (None, None)
+    if meeting_details.get('meeting_intent') != "Yes":
+        return None
+    current_status = meeting_result[1]
+    def schedule(start_time):
+        # A send that failed after creating the event already booked this slot; reuse the event rather than
+        # find our own booking as a conflict and tell the supplier the slot is taken.
+        if current_status == "scheduled" and scheduled_start(meeting_result[0]) == start_time:
+            return tuple(meeting_result)
+        return schedule_meeting(calendar_service, email_data['quotation_data'], email_data['email_address'],
+                                start_time, email_data['final_classification'])
+    ist = pytz.timezone('Asia/Kolkata')
+    error = None
+    try:
+        # Check instructions FIRST for new time or intent
+        reference_datetime = meeting_details.get("proposed_datetime", None)
+        interpretation = interpret_instructions(instructions, reference_datetime)
+        new_time_str = interpretation["datetime"]
+        should_schedule = interpretation["intent"] == "SCHEDULE"
+        # Replies are sent concurrently; the conflict check and insert for one slot must not interleave.
+        with scheduling_lock:
+            if instructions.strip() and new_time_str != "Not specified":
+                new_dt = datetime.fromisoformat(new_time_str)
+                if should_schedule:
+                    # User intends to schedule the new time
+                    email_data['meeting_result'] = schedule(new_dt)
+                else:
+                    # User intends to propose the new time
+                    email_data['meeting_result'] = (None, "proposed_for_confirmation")
+            elif current_status in (None, "No Meeting Requested"):
+                # No new time in instructions; try sender's time
+                proposed_dt_str = meeting_details.get("proposed_datetime")
+                if proposed_dt_str and proposed_dt_str != "Not specified":
+                    proposed_dt = datetime.fromisoformat(proposed_dt_str)
+                    start_time = proposed_dt
+                    end_time = start_time + timedelta(minutes=30)
+                    if start_time.hour < 9 or start_time.hour >= 17:
+                        email_data['meeting_result'] = (None, "outside_business_hours")
+                    elif start_time < datetime.now(ist):
+                        email_data['meeting_result'] = (None, "past_time")
+                    else:
+                        has_conflict, _ = check_calendar_conflict(calendar_service, start_time, end_time)
+                        if has_conflict:
+                            email_data['meeting_result'] = (None, "conflict")
+                        elif should_schedule:
+                            # Auto-schedule sender's time only if explicitly instructed
+                            email_data['meeting_result'] = schedule(proposed_dt)
+                        else:
+                            email_data['meeting_result'] = (None, "proposed_for_confirmation")
+                else:
+                    email_data['meeting_result'] = (None, "no_specific_time")
+            elif current_status in ("outside_business_hours", "conflict", "no_specific_time"):
+                # Try new time from instructions
+                if new_time_str != "Not specified":
                     new_dt = datetime.fromisoformat(new_time_str)
                     if should_schedule:
-                        # User intends to schedule the new time
-                        event, status = schedule_meeting(
-                            calendar_service,
-                            email_data['quotation_data'],
-                            email_data['email_address'],
-                            new_dt,
-                            email_data['final_classification']
-                        )
-                        email_data['meeting_result'] = (event, status)
+                        email_data['meeting_result'] = schedule(new_dt)
                     else:
-                        # User intends to propose the new time
                         email_data['meeting_result'] = (None, "proposed_for_confirmation")
-                elif current_status in (None, "No Meeting Requested"):
-                    # No new time in instructions; try sender's time
-                    proposed_dt_str = meeting_details.get("proposed_datetime")
-                    if proposed_dt_str and proposed_dt_str != "Not specified":
-                        proposed_dt = datetime.fromisoformat(proposed_dt_str)
-                        start_time = proposed_dt
-                        end_time = start_time + timedelta(minutes=30)
-                        if start_time.hour < 9 or start_time.hour >= 17:
-                            email_data['meeting_result'] = (None, "outside_business_hours")
-                        elif start_time < datetime.now(ist):
-                            email_data['meeting_result'] = (None, "past_time")
-                        else:
-                            has_conflict, _ = check_calendar_conflict(calendar_service, start_time, end_time)
-                            if has_conflict:
-                                email_data['meeting_result'] = (None, "conflict")
-                            elif should_schedule:
-                                # Auto-schedule sender's time only if explicitly instructed
-                                event, status = schedule_meeting(
-                                    calendar_service,
-                                    email_data['quotation_data'],
-                                    email_data['email_address'],
-                                    proposed_dt,
-                                    email_data['final_classification']
-                                )
-                                email_data['meeting_result'] = (event, status)
-                            else:
-                                email_data['meeting_result'] = (None, "proposed_for_confirmation")
-                    else:
-                        email_data['meeting_result'] = (None, "no_specific_time")
-                elif current_status in ("outside_business_hours", "conflict", "no_specific_time"):
-                    # Try new time from instructions
-                    if new_time_str != "Not specified":
-                        new_dt = datetime.fromisoformat(new_time_str)
-                        if should_schedule:
-                            event, status = schedule_meeting(
-                                calendar_service,
-                                email_data['quotation_data'],
-                                email_data['email_address'],
-                                new_dt,
-                                email_data['final_classification']
-                            )
-                            email_data['meeting_result'] = (event, status)
-                        else:
-                            email_data['meeting_result'] = (None, "proposed_for_confirmation")
-            except Exception as e:
-                email_data['meeting_result'] = (None, "parse_error")
-                st.error(f"Error processing meeting time: {str(e)}")
-        reply_body = get_reply_body(
-            email_data['final_classification'],
-            email_data['quotation_data'],
-            email_data['quotation_data'].get('sender_name'),
-            meeting_details,
-            email_data.get('meeting_result', (None, None)),
-            instructions
-        )
+    except LLMError:
+        # The instructions were never interpreted; fail the send so its claim is released for a retry.
+        raise
+    except Exception as e:
+        email_data['meeting_result'] = (None, "parse_error")
+        error = f"Error processing meeting time: {str(e)}"
+    update_meeting_result(email_data['account'], email_data['message_id'], email_data['meeting_result'])
+    return error
+def send_one_reply(service, calendar_service, email_data, instructions, drafts, scheduling_lock):
+    """Schedule, draft and send the reply for one email. Returns (status, message, warning) where status
+    is "sent", "skipped" (already replied), "pending" (an earlier send has not finished) or "failed"."""
+    claimed, previous_status = claim_reply(email_data)
+    if not claimed:
+        if previous_status == "sent":
+            return "skipped", f"Reply to {email_data['email_address']} was already sent", None
+        return "pending", None, (f"A previous reply to {email_data['email_address']} did not finish; check the "
+                                 f"Sent folder, then release it under Unfinished Replies to retry")
+    try:
+        warning = resolve_meeting_for_reply(calendar_service, email_data, instructions, scheduling_lock)
+        reply_body = get_reply_draft(email_data, instructions, drafts)
         success, message = send_reply(
             service,
             email_data['thread_id'],
@@ -935,29 +2173,70 @@ def send_replies_for_emails(service, calendar_service, emails, df):
             email_data['subject'],
             reply_body
         )
-        if success:
-            success_count += 1
-        else:
-            error_count += 1
+    except Exception as e:
+        success, message, warning = False, f"Error sending reply: {e}", None
+    if success:
+        mark_reply_sent(email_data['account'], email_data['message_id'])
+        return "sent", message, warning
+    release_reply(email_data['account'], email_data['message_id'])
+    return "failed", message, warning
+def send_replies_for_emails(service, calendar_service, emails, df, max_workers=MAX_CONCURRENT_SENDS):
+    selected_emails = [(email, row) for email, row in zip(emails, df.itertuples(index=False)) if getattr(row, 'Send')]
+    if not selected_emails:
+        st.warning("No emails selected to send replies.")
+        return
+    progress_bar = st.progress(0)
+    status_text = st.empty()
+    counts = {"sent": 0, "skipped": 0, "pending": 0, "failed": 0}
+    drafts = st.session_state.reply_drafts
+    scheduling_lock = threading.Lock()
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {
+            pool.submit(send_one_reply, service, calendar_service, email_data,
+                        getattr(row, 'Instructions', '') or '', drafts, scheduling_lock): email_data
+            for email_data, row in selected_emails
+        }
+        for i, future in enumerate(as_completed(futures), 1):
+            status, message, warning = future.result()
+            counts[status] += 1
+            if warning:
+                st.error(warning)
+            if status == "failed":
+                logger.error(message)
+            progress_bar.progress(i / len(selected_emails))
+            status_text.text(f'Sent {counts["sent"]} of {len(selected_emails)} replies...')
     progress_bar.progress(1.0)
     status_text.text('Bulk reply complete!')
-    if success_count > 0:
-        st.success(f"Successfully sent {success_count} replies!")
-    if error_count > 0:
-        st.error(f"Failed to send {error_count} replies.")
+    # Meeting results were updated in place; the tables must be rebuilt.
+    st.session_state.data_version += 1
+    if counts["sent"] > 0:
+        st.success(f"Successfully sent {counts['sent']} replies!")
+    if counts["skipped"] > 0:
+        st.info(f"Skipped {counts['skipped']} emails that were already replied to.")
+    if counts["pending"] > 0:
+        st.warning(f"Skipped {counts['pending']} emails whose earlier reply did not finish sending.")
+    if counts["failed"] > 0:
+        st.error(f"Failed to send {counts['failed']} replies.")
+def preview_replies(emails, df):
+    selected_emails = [(email, row) for email, row in zip(emails, df.itertuples(index=False)) if getattr(row, 'Send')]
+    if not selected_emails:
+        st.warning("No emails selected to preview.")
+        return
+    for email_data, row in selected_emails:
+        with st.expander(f"Reply to {email_data['email_address']}: {email_data['subject']}", expanded=True):
+            st.text(get_reply_draft(email_data, getattr(row, 'Instructions', '') or ''))
 def display_classification_tables(processed_emails):
     if not processed_emails:
         st.warning("No emails processed yet.")
         return
-    quotation_received = [e for e in processed_emails if e['final_classification'] == 'Quotation Received']
-    quotation_partial = [e for e in processed_emails if e['final_classification'] == 'Quotation Partially Received']
-    business_connection = [e for e in processed_emails if e['final_classification'] == 'New Business Connection']
-    unknown = [e for e in processed_emails if e['final_classification'] == 'Unknown']
+    master = build_master_table(st.session_state.table_session_id, st.session_state.data_version, processed_emails)
+    unknown = [processed_emails[i] for i in master.index[master['Classification'] == 'Unknown']]
     tabs = st.sidebar.radio("Select View", ["Quotations", "New Business Connections"])
     if tabs == "Quotations":
         st.header("Complete Quotations Received")
+        quotation_received, df_complete = table_view(master, processed_emails, 'Quotation Received',
+                                                     QUOTATION_TABLE_COLUMNS)
         if quotation_received:
-            df_complete = create_quotation_received_table(quotation_received)
             edited_df_complete = st.data_editor(
                 df_complete,
                 column_config={
@@ -971,21 +2250,24 @@ def display_classification_tables(processed_emails):
                 num_rows="dynamic",
                 hide_index=True
             )
-            csv_complete = edited_df_complete.to_csv(index=False)
+            csv_complete = table_csv("complete", df_complete, edited_df_complete)
             st.download_button(
                 label="Download Complete Quotations CSV",
                 data=csv_complete,
                 file_name=f"complete_quotations_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv",
                 mime="text/csv"
             )
+            if st.button("Preview Replies for Selected Complete Quotations"):
+                preview_replies(quotation_received, edited_df_complete)
             if st.button("Send Replies for Selected Complete Quotations"):
                 send_replies_for_emails(st.session_state.gmail_service, st.session_state.calendar_service,
                                         quotation_received, edited_df_complete)
         else:
             st.info("No complete quotations found in the processed emails.")
         st.header("Partial Quotations Received")
+        quotation_partial, df_partial = table_view(master, processed_emails, 'Quotation Partially Received',
+                                                   PARTIAL_TABLE_COLUMNS)
         if quotation_partial:
-            df_partial = create_quotation_partial_table(quotation_partial)
             edited_df_partial = st.data_editor(
                 df_partial,
                 column_config={
@@ -999,13 +2281,15 @@ def display_classification_tables(processed_emails):
                 num_rows="dynamic",
                 hide_index=True
             )
-            csv_partial = edited_df_partial.to_csv(index=False)
+            csv_partial = table_csv("partial", df_partial, edited_df_partial)
             st.download_button(
                 label="Download Partial Quotations CSV",
                 data=csv_partial,
                 file_name=f"partial_quotations_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv",
                 mime="text/csv"
             )
+            if st.button("Preview Replies for Selected Partial Quotations"):
+                preview_replies(quotation_partial, edited_df_partial)
             if st.button("Send Replies for Selected Partial Quotations"):
                 send_replies_for_emails(st.session_state.gmail_service, st.session_state.calendar_service,
                                         quotation_partial, edited_df_partial)
@@ -1013,8 +2297,9 @@ def display_classification_tables(processed_emails):
             st.info("No partial quotations found in the processed emails.")
     elif tabs == "New Business Connections":
         st.header("New Business Connections")
+        business_connection, df_business = table_view(master, processed_emails, 'New Business Connection',
+                                                      BUSINESS_TABLE_COLUMNS)
         if business_connection:
-            df_business = create_business_connection_table(business_connection)
             edited_df_business = st.data_editor(
                 df_business,
                 column_config={
@@ -1028,13 +2313,15 @@ def display_classification_tables(processed_emails):
                 num_rows="dynamic",
                 hide_index=True
             )
-            csv_business = edited_df_business.to_csv(index=False)
+            csv_business = table_csv("business", df_business, edited_df_business)
             st.download_button(
                 label="Download Business Connections CSV",
                 data=csv_business,
                 file_name=f"business_connections_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv",
                 mime="text/csv"
             )
+            if st.button("Preview Replies for Selected Business Connections"):
+                preview_replies(business_connection, edited_df_business)
             if st.button("Send Replies for Selected Business Connections"):
                 send_replies_for_emails(st.session_state.gmail_service, st.session_state.calendar_service,
                                         business_connection, edited_df_business)
@@ -1045,58 +2332,818 @@ def display_classification_tables(processed_emails):
         st.warning(f"Found {len(unknown)} emails that could not be properly classified:")
         for email in unknown:
             st.write(f"- {email['email_address']}: {email['subject']}")
-def process_emails(gmail_service, calendar_service, num_emails=5):
+def display_unfinished_replies():
+    stale = stale_reply_claims(session_account())
+    if not stale:
+        return
+    st.header("Unfinished Replies")
+    st.warning(f"{len(stale)} replies were claimed more than {REPLY_CLAIM_STALE_SECONDS // 60} minutes ago but never "
+               f"confirmed as sent, so they are blocked from sending. Check the Sent folder before releasing them; "
+               f"a reply that did go out would be sent twice.")
+    import pandas as pd
+    st.dataframe(pd.DataFrame([{
+        "Email": row["email_address"],
+        "Subject": row["subject"],
+        "Claimed At": datetime.fromtimestamp(row["claimed_at"]).strftime("%Y-%m-%d %H:%M")
+    } for row in stale]), use_container_width=True, hide_index=True)
+    if st.button("Release unfinished replies"):
+        release_stale_reply_claims(session_account())
+        st.rerun()
+def display_failed_emails():
+    failed = load_failed_emails(session_account())
+    if not failed:
+        return
+    st.header("Analysis Failed")
+    st.warning(f"{len(failed)} emails could not be fetched or analyzed. They are not in the tables above and will "
+               f"be retried on the next run.")
+    import pandas as pd
+    st.dataframe(pd.DataFrame([{
+        "Email": row["email_address"],
+        "Subject": row["subject"],
+        "Failure": FAILURE_LABELS.get(row["state"], row["state"]),
+        "Attempts": row["attempts"],
+        "Last Attempt": datetime.fromtimestamp(row["failed_at"]).strftime("%Y-%m-%d %H:%M"),
+        "Error": row["error"]
+    } for row in failed]), use_container_width=True, hide_index=True)
+    if st.button("Retry failed emails"):
+        with st.spinner("Retrying..."):
+            retried = list(iter_process_messages(st.session_state.gmail_service, session_account(),
+                                                 [row["message_id"] for row in failed], MAX_CONCURRENT_EMAILS))
+        st.success(f"{len(retried)} of {len(failed)} emails processed.")
+        reload_processed_emails()
+        st.rerun()
+_thread_local = threading.local()
+def thread_http(service):
+    """Return an authorized http object owned by the current thread (httplib2 is not thread-safe)."""
+    if not hasattr(_thread_local, 'http'):
+        _thread_local.http = {}
+    credentials = getattr(service._http, 'credentials', None)
+    if credentials is None:
+        return service._http
+    # Keyed on the account's grant, not the service object, whose id can be reused once it is collected.
+    key = credentials.refresh_token or credentials.token
+    if key not in _thread_local.http:
+        import httplib2
+        from google_auth_httplib2 import AuthorizedHttp
+        _thread_local.http[key] = AuthorizedHttp(credentials, http=httplib2.Http(timeout=STAGE_TIMEOUTS["fetch"]))
+    return _thread_local.http[key]
+def is_retryable_http_error(error):
+    if not isinstance(error, HttpError):
+        return False
+    status = error.resp.status
+    return status == 429 or status >= 500 or (status == 403 and b'rateLimitExceeded' in (error.content or b''))
+def fetch_messages_batched(gmail_service, message_ids):
+    """Fetch messages with Gmail batch requests. Returns ({message_id: message}, {message_id: error})."""
+    messages = {}
+    errors = {}
+    pending = list(message_ids)
+    for attempt in range(GMAIL_BATCH_RETRIES + 1):
+        retry = []
+        def callback(request_id, response, exception):
+            if exception is None:
+                messages[request_id] = response
+                errors.pop(request_id, None)
+            else:
+                errors[request_id] = exception
+                if is_retryable_http_error(exception):
+                    retry.append(request_id)
+        for start in range(0, len(pending), GMAIL_BATCH_SIZE):
+            batch = gmail_service.new_batch_http_request(callback=callback)
+            for message_id in pending[start:start + GMAIL_BATCH_SIZE]:
+                batch.add(
+                    gmail_service.users().messages().get(userId='me', id=message_id, fields=GMAIL_MESSAGE_FIELDS),
+                    request_id=message_id
+                )
+            batch.execute(http=thread_http(gmail_service))
+        if not retry or attempt == GMAIL_BATCH_RETRIES:
+            break
+        pending = retry
+        time.sleep(backoff_delay(attempt))
+    for message_id, error in errors.items():
+        logger.error(f"Could not fetch message {message_id}: {error}")
+    return messages, errors
+def submit_stage(stage_pool, stage, fallback, func, *args):
+    """Start one pipeline stage on the stage pool; the returned callable waits for it with the stage timeout."""
+    future = stage_pool.submit(func, *args)
+    def result():
+        # Request-layer failures and timeouts raise LLMError so the email is not stored with made-up values;
+        # fallback only covers other errors, e.g. an unparseable response.
+        try:
+            return future.result(timeout=STAGE_TIMEOUTS[stage])
+        except FutureTimeoutError:
+            future.cancel()
+            raise LLMError("timeout", f"Stage '{stage}' timed out after {STAGE_TIMEOUTS[stage]}s")
+        except LLMError:
+            raise
+        except Exception as e:
+            logger.warning(f"Stage '{stage}' failed: {e}")
+        return fallback() if callable(fallback) else fallback
+    return result
+def stage_failure(stage):
+    """Fallback for a stage with no safe default value: the email is recorded as failed instead of stored."""
+    def fail():
+        raise LLMError("error", f"Stage '{stage}' failed")
+    return fail
+def analyze_email(body, stage_pool):
+    """Return (initial_classification, classification_source, meeting_details, quotation_data) for one email."""
+    if ANALYSIS_MODE == "fused":
+        # An LLMError, timeouts included, fails the email: the staged requests would only add load to a
+        # rate-limited or slow API while the fused request may still be running.
+        fused = submit_stage(stage_pool, "analysis", None, analyze_email_fused, body)()
+        if fused is not None:
+            return fused
+        logger.warning("Fused analysis failed; falling back to separate requests")
+    # Meeting detection and classification are independent, so both requests are in flight together.
+    meeting_result = submit_stage(stage_pool, "meeting", no_meeting_details, extract_meeting_details, body)
+    classification_result = submit_stage(stage_pool, "classification", ("Unknown", "llm"),
+                                         classify_email_intent_with_source, body)
+    meeting_details = meeting_result()
+    initial_classification, classification_source = classification_result()
+    extraction_result = submit_stage(stage_pool, "extraction", stage_failure("extraction"),
+                                     extract_quotation_data, body, initial_classification)
+    return initial_classification, classification_source, meeting_details, extraction_result()
+def process_single_email(msg, stage_pool):
+    headers = msg['payload']['headers']
+    sender = [h['value'] for h in headers if h['name'] == 'From'][0]
+    subject = next((h['value'] for h in headers if h['name'] == 'Subject'), "(no subject)")
+    thread_id = msg['threadId']
+    raw_body = get_email_body(msg['payload'])
+    body = clean_email_body(raw_body)
+    initial_classification, classification_source, meeting_details, quotation_data = analyze_email(body, stage_pool)
+    final_classification = get_final_classification(quotation_data, initial_classification)
+    name = sender.split("<")[0].strip() if "<" in sender else sender
+    email_address = sender.split("<")[1][:-1] if "<" in sender else sender
+    return {
+        "message_id": msg['id'],
+        "email_address": email_address,
+        "subject": subject,
+        "body": body,
+        "raw_body_tokens": estimate_tokens(raw_body),
+        "body_tokens": estimate_tokens(body),
+        "received_at": int(msg.get('internalDate', 0)),
+        "initial_classification": initial_classification,
+        "classification_source": classification_source,
+        "final_classification": final_classification,
+        "quotation_data": quotation_data,
+        "meeting_details": meeting_details,
+        "meeting_result": None,
+        "thread_id": thread_id
+    }
+# Gmail message ids are per mailbox, so stored, replied-to and failed emails are keyed by (account, message_id).
+PROCESSED_EMAILS_TABLE = """
+    CREATE TABLE IF NOT EXISTS {table} (
+        account TEXT NOT NULL,
+        message_id TEXT NOT NULL,
+        thread_id TEXT NOT NULL,
+        email_address TEXT,
+        subject TEXT,
+        body TEXT,
+        received_at INTEGER,
+        initial_classification TEXT,
+        final_classification TEXT,
+        quotation_data TEXT,
+        meeting_details TEXT,
+        meeting_result TEXT,
+        processed_at REAL NOT NULL,
+        classification_source TEXT,
+        raw_body_tokens INTEGER,
+        body_tokens INTEGER,
+        PRIMARY KEY (account, message_id)
+    )
+"""
+# One row per replied-to message; the primary key is the idempotency key for bulk sends.
+SENT_REPLIES_TABLE = """
+    CREATE TABLE IF NOT EXISTS {table} (
+        account TEXT NOT NULL,
+        message_id TEXT NOT NULL,
+        thread_id TEXT NOT NULL,
+        status TEXT NOT NULL,
+        claimed_at REAL NOT NULL,
+        sent_at REAL,
+        PRIMARY KEY (account, message_id)
+    )
+"""
+# Emails whose processing failed; retried on the next run until they succeed.
+FAILED_EMAILS_TABLE = """
+    CREATE TABLE IF NOT EXISTS {table} (
+        account TEXT NOT NULL,
+        message_id TEXT NOT NULL,
+        thread_id TEXT,
+        email_address TEXT,
+        subject TEXT,
+        state TEXT NOT NULL,
+        error TEXT,
+        attempts INTEGER NOT NULL DEFAULT 1,
+        failed_at REAL NOT NULL,
+        PRIMARY KEY (account, message_id)
+    )
+"""
+def _key_by_account(conn, table, create_sql):
+    """Rebuild a table created before rows were keyed by account. Its rows get account '' until
+    adopt_unowned_emails hands them to a mailbox."""
+    if 'account' in {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}:
+        return
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        columns = [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+        if 'account' not in columns:
+            conn.execute(f"ALTER TABLE {table} RENAME TO {table}_unkeyed")
+            conn.execute(create_sql.format(table=table))
+            conn.execute(f"INSERT INTO {table} (account, {', '.join(columns)}) "
+                         f"SELECT '', {', '.join(columns)} FROM {table}_unkeyed")
+            conn.execute(f"DROP TABLE {table}_unkeyed")
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+def email_store_connect():
+    conn = sqlite_connect(EMAIL_STORE_PATH)
+    conn.execute(PROCESSED_EMAILS_TABLE.format(table="processed_emails"))
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(processed_emails)")}
+    if 'classification_source' not in columns:
+        conn.execute("ALTER TABLE processed_emails ADD COLUMN classification_source TEXT")
+    if 'body_tokens' not in columns:
+        conn.execute("ALTER TABLE processed_emails ADD COLUMN raw_body_tokens INTEGER")
+        conn.execute("ALTER TABLE processed_emails ADD COLUMN body_tokens INTEGER")
+    _key_by_account(conn, "processed_emails", PROCESSED_EMAILS_TABLE)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_processed_emails_thread ON processed_emails (thread_id)")
+    conn.execute(SENT_REPLIES_TABLE.format(table="sent_replies"))
+    _key_by_account(conn, "sent_replies", SENT_REPLIES_TABLE)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS worker_status (
+            worker_id TEXT PRIMARY KEY,
+            started_at REAL NOT NULL,
+            last_run_at REAL,
+            last_processed INTEGER,
+            total_processed INTEGER NOT NULL DEFAULT 0,
+            last_error TEXT
+        )
+    """)
+    # Resume point of each backfill: the page token of the first page not yet fully processed.
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS backfill_jobs (
+            job_id TEXT PRIMARY KEY,
+            account TEXT NOT NULL,
+            query TEXT NOT NULL,
+            page_token TEXT,
+            processed INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            status TEXT NOT NULL,
+            updated_at REAL NOT NULL
+        )
+    """)
+    conn.execute(FAILED_EMAILS_TABLE.format(table="failed_emails"))
+    _key_by_account(conn, "failed_emails", FAILED_EMAILS_TABLE)
+    return conn
+def adopt_unowned_emails(account):
+    """Give rows stored before emails were keyed by account to this mailbox, the first one to use the store."""
+    conn = email_store_connect()
+    try:
+        with conn:
+            for table in ("processed_emails", "sent_replies", "failed_emails"):
+                conn.execute(f"UPDATE OR IGNORE {table} SET account = ? WHERE account = ''", (account,))
+    finally:
+        conn.close()
+def store_processed_email(email_data):
+    conn = email_store_connect()
+    try:
+        with conn:
+            conn.execute("""
+                INSERT OR REPLACE INTO processed_emails (
+                    account, message_id, thread_id, email_address, subject, body, received_at,
+                    initial_classification, final_classification, quotation_data, meeting_details, meeting_result,
+                    processed_at, classification_source, raw_body_tokens, body_tokens
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, (
+                email_data['account'],
+                email_data['message_id'],
+                email_data['thread_id'],
+                email_data['email_address'],
+                email_data['subject'],
+                email_data.get('body'),
+                email_data.get('received_at'),
+                email_data.get('initial_classification'),
+                email_data['final_classification'],
+                json.dumps(email_data['quotation_data']),
+                json.dumps(email_data.get('meeting_details')),
+                json.dumps(email_data.get('meeting_result')),
+                time.time(),
+                email_data.get('classification_source'),
+                email_data.get('raw_body_tokens'),
+                email_data.get('body_tokens')
+            ))
+    finally:
+        conn.close()
+def claim_reply(email_data):
+    """Reserve the reply to this message. Returns (True, None) when claimed, else (False, existing status)."""
+    conn = email_store_connect()
+    try:
+        with conn:
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO sent_replies (account, message_id, thread_id, status, claimed_at) "
+                "VALUES (?, ?, ?, 'pending', ?)",
+                (email_data['account'], email_data['message_id'], email_data['thread_id'], time.time())
+            )
+            if cursor.rowcount == 1:
+                return True, None
+            row = conn.execute("SELECT status FROM sent_replies WHERE account = ? AND message_id = ?",
+                               (email_data['account'], email_data['message_id'])).fetchone()
+            return False, row[0]
+    finally:
+        conn.close()
+def mark_reply_sent(account, message_id):
+    conn = email_store_connect()
+    try:
+        with conn:
+            conn.execute("UPDATE sent_replies SET status = 'sent', sent_at = ? WHERE account = ? AND message_id = ?",
+                         (time.time(), account, message_id))
+    finally:
+        conn.close()
+def release_reply(account, message_id):
+    """Drop a claim whose send definitely failed so the reply can be retried."""
+    conn = email_store_connect()
+    try:
+        with conn:
+            conn.execute("DELETE FROM sent_replies WHERE account = ? AND message_id = ? AND status = 'pending'",
+                         (account, message_id))
+    finally:
+        conn.close()
+def stale_reply_claims(account=None, max_age=REPLY_CLAIM_STALE_SECONDS):
+    """Pending reply claims older than max_age, with the email they belong to; account=None means every mailbox."""
+    conn = email_store_connect()
+    try:
+        rows = conn.execute("""
+            SELECT r.message_id, p.email_address, p.subject, r.claimed_at
+            FROM sent_replies r
+            LEFT JOIN processed_emails p ON p.account = r.account AND p.message_id = r.message_id
+            WHERE r.status = 'pending' AND r.claimed_at < ? AND (? IS NULL OR r.account = ?) ORDER BY r.claimed_at
+        """, (time.time() - max_age, account, account)).fetchall()
+    finally:
+        conn.close()
+    return [dict(zip(["message_id", "email_address", "subject", "claimed_at"], row)) for row in rows]
+def release_stale_reply_claims(account=None, max_age=REPLY_CLAIM_STALE_SECONDS):
+    """Drop pending claims older than max_age so those replies can be sent again; returns how many."""
+    conn = email_store_connect()
+    try:
+        with conn:
+            return conn.execute("""
+                DELETE FROM sent_replies WHERE status = 'pending' AND claimed_at < ?
+                AND (? IS NULL OR account = ?)
+            """, (time.time() - max_age, account, account)).rowcount
+    finally:
+        conn.close()
+def email_store_revision(account):
+    """Cheap fingerprint of a mailbox's stored emails; it changes whenever a worker or another session adds some."""
+    conn = email_store_connect()
+    try:
+        return conn.execute("SELECT COUNT(*), MAX(processed_at) FROM processed_emails WHERE account = ?",
+                            (account,)).fetchone()
+    finally:
+        conn.close()
+def record_worker_heartbeat(worker_id, started_at, processed=None, error=None):
+    conn = email_store_connect()
+    try:
+        with conn:
+            conn.execute("""
+                INSERT INTO worker_status (worker_id, started_at, last_run_at, last_processed, total_processed,
+                                           last_error)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT(worker_id) DO UPDATE SET
+                    last_run_at = excluded.last_run_at,
+                    last_processed = excluded.last_processed,
+                    total_processed = total_processed + excluded.total_processed,
+                    last_error = excluded.last_error
+            """, (worker_id, started_at, time.time(), processed, processed or 0, error))
+    finally:
+        conn.close()
+def latest_worker_status():
+    conn = email_store_connect()
+    try:
+        row = conn.execute("""
+            SELECT worker_id, started_at, last_run_at, last_processed, total_processed, last_error
+            FROM worker_status ORDER BY last_run_at DESC LIMIT 1
+        """).fetchone()
+    finally:
+        conn.close()
+    if not row:
+        return None
+    return dict(zip(["worker_id", "started_at", "last_run_at", "last_processed", "total_processed", "last_error"], row))
+def load_backfill_job(job_id):
+    conn = email_store_connect()
+    try:
+        row = conn.execute("""
+            SELECT job_id, account, query, page_token, processed, failed, status, updated_at
+            FROM backfill_jobs WHERE job_id = ?
+        """, (job_id,)).fetchone()
+    finally:
+        conn.close()
+    if not row:
+        return None
+    return dict(zip(["job_id", "account", "query", "page_token", "processed", "failed", "status", "updated_at"], row))
+def save_backfill_job(job_id, account, query, page_token, processed, failed, status):
+    conn = email_store_connect()
+    try:
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO backfill_jobs VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                         (job_id, account, query, page_token, processed, failed, status, time.time()))
+    finally:
+        conn.close()
+def delete_backfill_job(job_id):
+    conn = email_store_connect()
+    try:
+        with conn:
+            conn.execute("DELETE FROM backfill_jobs WHERE job_id = ?", (job_id,))
+    finally:
+        conn.close()
+def body_token_report(account, limit=50):
+    """(totals, rows) of estimated body tokens before and after preprocessing, newest emails first."""
+    conn = email_store_connect()
+    try:
+        totals = conn.execute("""
+            SELECT COUNT(*), SUM(raw_body_tokens), SUM(body_tokens) FROM processed_emails
+            WHERE account = ? AND raw_body_tokens IS NOT NULL
+        """, (account,)).fetchone()
+        rows = conn.execute("""
+            SELECT subject, email_address, raw_body_tokens, body_tokens FROM processed_emails
+            WHERE account = ? AND raw_body_tokens IS NOT NULL ORDER BY processed_at DESC LIMIT ?
+        """, (account, limit)).fetchall()
+    finally:
+        conn.close()
+    return totals, rows
+def record_failed_email(account, msg, state, error):
+    headers = {h['name']: h['value'] for h in msg.get('payload', {}).get('headers', [])}
+    conn = email_store_connect()
+    try:
+        with conn:
+            conn.execute("""
+                INSERT INTO failed_emails (account, message_id, thread_id, email_address, subject, state, error,
+                                           failed_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(account, message_id) DO UPDATE SET
+                    state = excluded.state, error = excluded.error, attempts = attempts + 1,
+                    failed_at = excluded.failed_at
+            """, (account, msg['id'], msg.get('threadId'), headers.get('From'), headers.get('Subject'), state,
+                  error, time.time()))
+    finally:
+        conn.close()
+def clear_failed_email(account, message_id):
+    conn = email_store_connect()
+    try:
+        with conn:
+            conn.execute("DELETE FROM failed_emails WHERE account = ? AND message_id = ?", (account, message_id))
+    finally:
+        conn.close()
+def failed_message_ids(account):
+    conn = email_store_connect()
+    try:
+        return [row[0] for row in conn.execute(
+            "SELECT message_id FROM failed_emails WHERE account = ? ORDER BY failed_at", (account,))]
+    finally:
+        conn.close()
+def load_failed_emails(account):
+    conn = email_store_connect()
+    try:
+        rows = conn.execute("""
+            SELECT message_id, email_address, subject, state, error, attempts, failed_at
+            FROM failed_emails WHERE account = ? ORDER BY failed_at DESC
+        """, (account,)).fetchall()
+    finally:
+        conn.close()
+    return [dict(zip(["message_id", "email_address", "subject", "state", "error", "attempts", "failed_at"], row))
+            for row in rows]
+def update_meeting_result(account, message_id, meeting_result):
+    conn = email_store_connect()
+    try:
+        with conn:
+            conn.execute("UPDATE processed_emails SET meeting_result = ? WHERE account = ? AND message_id = ?",
+                         (json.dumps(meeting_result), account, message_id))
+    finally:
+        conn.close()
+def stored_message_ids(account, message_ids):
+    message_ids = list(message_ids)
+    conn = email_store_connect()
+    try:
+        stored = set()
+        # Stay well below SQLite's bound-parameter limit.
+        for start in range(0, len(message_ids), 500):
+            chunk = message_ids[start:start + 500]
+            rows = conn.execute(
+                f"SELECT message_id FROM processed_emails WHERE account = ? "
+                f"AND message_id IN ({','.join('?' * len(chunk))})", [account] + chunk
+            ).fetchall()
+            stored.update(row[0] for row in rows)
+        return stored
+    finally:
+        conn.close()
+def load_processed_emails(account):
+    """Return every email stored for account, newest first, in the shape the tables and chatbot expect."""
+    conn = email_store_connect()
+    try:
+        rows = conn.execute("""
+            SELECT message_id, thread_id, email_address, subject, received_at, initial_classification,
+                   final_classification, quotation_data, meeting_details, meeting_result, processed_at
+            FROM processed_emails WHERE account = ? ORDER BY received_at DESC, processed_at DESC
+        """, (account,)).fetchall()
+    finally:
+        conn.close()
+    # Costs are derived across all stored quotations at once rather than per email in the workers.
+    return derive_batch_costs([{
+        "message_id": row[0],
+        "thread_id": row[1],
+        "email_address": row[2],
+        "subject": row[3],
+        "received_at": row[4],
+        "initial_classification": row[5],
+        "final_classification": row[6],
+        "quotation_data": json.loads(row[7]),
+        "meeting_details": json.loads(row[8]) if row[8] else None,
+        "meeting_result": json.loads(row[9]) if row[9] else None,
+        "processed_at": row[10],
+        "account": account
+    } for row in rows])
+def load_sync_state():
+    try:
+        with open(SYNC_STATE_PATH, "r") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+def save_sync_state(account, history_id):
+    state = load_sync_state()
+    state[account] = {"history_id": str(history_id), "synced_at": datetime.now(pytz.utc).isoformat()}
+    tmp_path = SYNC_STATE_PATH + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp_path, SYNC_STATE_PATH)
+def is_primary_inbox_message(label_ids):
+    # Mirrors q='category:primary' for accounts with inbox categories; other accounts have no CATEGORY_* labels.
+    if 'INBOX' not in label_ids:
+        return False
+    categories = [label for label in label_ids if label.startswith('CATEGORY_')]
+    return not categories or 'CATEGORY_PERSONAL' in categories
+def list_messages_since(gmail_service, start_history_id):
+    """Return [(history_id, message stub)] for inbox messages added after start_history_id, oldest first."""
+    added = []
+    seen = set()
+    page_token = None
+    while True:
+        response = gmail_service.users().history().list(
+            userId='me',
+            startHistoryId=start_history_id,
+            historyTypes=['messageAdded'],
+            labelId='INBOX',
+            pageToken=page_token
+        ).execute(http=thread_http(gmail_service))
+        for record in response.get('history', []):
+            for item in record.get('messagesAdded', []):
+                message = item['message']
+                if message['id'] in seen or not is_primary_inbox_message(message.get('labelIds', [])):
+                    continue
+                seen.add(message['id'])
+                added.append((record['id'], {"id": message['id'], "threadId": message['threadId']}))
+        page_token = response.get('nextPageToken')
+        if not page_token:
+            return added
+def list_messages_to_process(gmail_service, num_emails, incremental=True):
+    """Return (message stubs newest first, mailbox address, historyId to store once they are processed)."""
+    profile = gmail_service.users().getProfile(userId='me').execute(http=thread_http(gmail_service))
+    account = profile['emailAddress']
+    adopt_unowned_emails(account)
+    start_history_id = load_sync_state().get(account, {}).get('history_id')
+    if incremental and start_history_id:
+        try:
+            added = list_messages_since(gmail_service, start_history_id)
+            # When more mail arrived than we process now, stop the checkpoint at the last message taken
+            # so the remainder is picked up by the next run.
+            if len(added) > num_emails:
+                added = added[:num_emails]
+                checkpoint = added[-1][0]
+            else:
+                checkpoint = profile['historyId']
+            return [message for _, message in reversed(added)], account, checkpoint
+        except HttpError as e:
+            if e.resp.status != 404:
+                raise
+            logger.info(f"History {start_history_id} for {account} has expired; falling back to a full inbox list")
     results = gmail_service.users().messages().list(
         userId='me',
         q='category:primary',
         labelIds=['INBOX']
-    ).execute()
-    messages = results.get('messages', [])
+    ).execute(http=thread_http(gmail_service))
+    return results.get('messages', [])[:num_emails], account, profile['historyId']
+def _log_notice(level, message):
+    (logger.warning if level == "warning" else logger.info)(message)
+def process_and_store_email(account, msg, stage_pool):
+    # Storing inside the task keeps the result even if the consumer of the stream has gone away.
+    try:
+        email_data = process_single_email(msg, stage_pool)
+    except LLMError as e:
+        # Not stored as processed, so the next run retries it instead of keeping placeholder values.
+        record_failed_email(account, msg, e.state, str(e))
+        raise
+    except Exception as e:
+        # Recorded too: the sync checkpoint moves past this message, so the retry table is its only way back.
+        record_failed_email(account, msg, "processing", str(e))
+        raise
+    email_data['account'] = account
+    store_processed_email(email_data)
+    clear_failed_email(account, email_data['message_id'])
+    return email_data
+def iter_process_messages(gmail_service, account, message_ids, max_workers, on_done=None):
+    """Fetch, analyze and store message_ids, yielding each email as it finishes; on_done() is called per
+    message, failed or not. Returns the number of messages that failed."""
+    fetched, fetch_errors = fetch_messages_batched(gmail_service, message_ids)
+    failed = len(fetch_errors)
+    for message_id, error in fetch_errors.items():
+        # A deleted message (404) will never be fetched; anything else is retried on the next run.
+        if isinstance(error, HttpError) and error.resp.status == 404:
+            clear_failed_email(account, message_id)
+        else:
+            record_failed_email(account, {"id": message_id}, "fetch", str(error))
+    for _ in fetch_errors:
+        if on_done:
+            on_done()
+    # Stage tasks never submit further work, so a separate pool of twice the size cannot deadlock.
+    stage_pool = ThreadPoolExecutor(max_workers=max_workers * 2)
+    email_pool = ThreadPoolExecutor(max_workers=max_workers)
+    finished = False
+    try:
+        futures = {
+            email_pool.submit(process_and_store_email, account, fetched[message_id], stage_pool): message_id
+            for message_id in message_ids if message_id in fetched
+        }
+        for future in as_completed(futures):
+            try:
+                email_data = future.result()
+            except Exception as e:
+                failed += 1
+                logger.error(f"Error processing message {futures[future]}: {e}")
+                email_data = None
+            if on_done:
+                on_done()
+            if email_data is not None:
+                yield email_data
+        finished = True
+    finally:
+        email_pool.shutdown(wait=False, cancel_futures=True)
+        # After an interruption the stage tasks of in-flight emails must still run for them to be stored.
+        stage_pool.shutdown(wait=False, cancel_futures=finished)
+    return failed
+def iter_ingest_emails(gmail_service, num_emails=5, max_workers=MAX_CONCURRENT_EMAILS, incremental=False,
+                       on_progress=None, notify=_log_notice):
+    """List, fetch, analyze and store new inbox messages without touching the UI, yielding each stored email
+    as soon as it finishes. on_progress(completed, total) is called as emails finish; notify(level, message)
+    receives the run's notices. Closing the generator early keeps everything stored so far, lets emails
+    already in flight finish and be stored, and leaves the sync checkpoint for the next run."""
+    messages, account, checkpoint = list_messages_to_process(gmail_service, num_emails, incremental)
+    listed = {message['id'] for message in messages}
+    retries = [{"id": message_id} for message_id in failed_message_ids(account) if message_id not in listed]
+    if not messages and not retries:
+        if incremental:
+            notify("info", "No new messages since the last sync.")
+            save_sync_state(account, checkpoint)
+        else:
+            notify("warning", "No messages found in inbox.")
+        return
+    already_stored = stored_message_ids(account, (message['id'] for message in messages))
+    messages = [message for message in messages if message['id'] not in already_stored] + retries
     if not messages:
-        st.warning("No messages found in inbox.")
+        notify("info", "All of these messages have already been processed.")
+        save_sync_state(account, checkpoint)
+        return
+    total = len(messages)
+    if on_progress:
+        on_progress(0, total)
+    completed = 0
+    def on_done():
+        nonlocal completed
+        completed += 1
+        if on_progress:
+            on_progress(completed, total)
+    failed = yield from iter_process_messages(gmail_service, account, [message['id'] for message in messages],
+                                              max_workers, on_done)
+    if failed:
+        notify("warning", f"{failed} emails could not be processed.")
+    save_sync_state(account, checkpoint)
+def backfill_query(after=None, before=None, label="INBOX"):
+    """Gmail search for a backfill window; after/before are dates, label a label name."""
+    label = (label or "INBOX").strip()
+    parts = ["in:inbox category:primary"] if label.upper() == "INBOX" else [f"label:{label.replace(' ', '-')}"]
+    if after:
+        parts.append(f"after:{after.strftime('%Y/%m/%d')}")
+    if before:
+        parts.append(f"before:{before.strftime('%Y/%m/%d')}")
+    return " ".join(parts)
+def backfill_job_id(account, query):
+    return hashlib.sha256(f"{account}\n{query}".encode()).hexdigest()[:16]
+def iter_backfill(gmail_service, after=None, before=None, label="INBOX", max_workers=MAX_CONCURRENT_EMAILS,
+                  on_progress=None, notify=_log_notice, restart=False):
+    """Page through every message matching the window, processing and storing the ones not stored yet and
+    yielding each as it finishes. The page token is checkpointed after each page, so an interrupted
+    backfill resumes at the page it stopped in. on_progress(done, estimated_total) tracks messages seen."""
+    account = gmail_service.users().getProfile(userId='me').execute(http=thread_http(gmail_service))['emailAddress']
+    adopt_unowned_emails(account)
+    query = backfill_query(after, before, label)
+    job_id = backfill_job_id(account, query)
+    if restart:
+        delete_backfill_job(job_id)
+    job = load_backfill_job(job_id)
+    if job and job["status"] == "done":
+        notify("info", f"Backfill for '{query}' already completed ({job['processed']} emails stored); restart it to rescan.")
         return
-    processed_emails = []
+    page_token = job["page_token"] if job else None
+    processed = job["processed"] if job else 0
+    failed = job["failed"] if job else 0
+    if job:
+        notify("info", f"Resuming backfill for '{query}' after {processed} emails.")
+    seen = 0
+    while True:
+        response = gmail_service.users().messages().list(
+            userId='me',
+            q=query,
+            maxResults=BACKFILL_PAGE_SIZE,
+            pageToken=page_token
+        ).execute(http=thread_http(gmail_service))
+        page_ids = [message['id'] for message in response.get('messages', [])]
+        already_stored = stored_message_ids(account, page_ids)
+        new_ids = [message_id for message_id in page_ids if message_id not in already_stored]
+        estimate = max(response.get('resultSizeEstimate', 0), seen + len(page_ids))
+        seen += len(already_stored)
+        def on_done():
+            nonlocal seen
+            seen += 1
+            if on_progress:
+                on_progress(seen, estimate)
+        if on_progress:
+            on_progress(seen, estimate)
+        page_failed = yield from iter_process_messages(gmail_service, account, new_ids, max_workers, on_done)
+        # Counted per finished page, including messages stored before (e.g. in flight when interrupted).
+        processed += len(page_ids) - page_failed
+        failed += page_failed
+        page_token = response.get('nextPageToken')
+        save_backfill_job(job_id, account, query, page_token, processed, failed, "running" if page_token else "done")
+        if not page_token:
+            break
+    if failed:
+        notify("warning", f"{failed} emails could not be processed during the backfill.")
+    notify("info", f"Backfill for '{query}' complete: {processed} emails stored.")
+def ingest_emails(gmail_service, num_emails=5, max_workers=MAX_CONCURRENT_EMAILS, incremental=False,
+                  on_progress=None, notify=_log_notice):
+    return list(iter_ingest_emails(gmail_service, num_emails, max_workers, incremental, on_progress, notify))
+def live_preview_row(email_data):
+    qd = email_data['quotation_data']
+    return {
+        'Classification': email_data['final_classification'],
+        'Email': email_data['email_address'],
+        'Subject': email_data['subject'],
+        'Product': qd.get('product', 'Not present'),
+        'Unit Price': qd.get('unit_price', 'Not present'),
+        'Lead Time': qd.get('lead_time', 'Not present'),
+        'Meeting Status': get_meeting_status(email_data.get('meeting_details'), email_data.get('meeting_result'))
+    }
+def process_emails(gmail_service, calendar_service, num_emails=5, max_workers=MAX_CONCURRENT_EMAILS,
+                   incremental=False):
+    import pandas as pd
     progress_bar = st.progress(0)
     status_text = st.empty()
-    for i, message in enumerate(messages[:num_emails]):
-        progress = (i + 1) / num_emails
-        progress_bar.progress(progress)
-        status_text.text(f'Processing email {i + 1} of {num_emails}...')
-        msg = gmail_service.users().messages().get(userId='me', id=message['id']).execute()
-        headers = msg['payload']['headers']
-        sender = [h['value'] for h in headers if h['name'] == 'From'][0]
-        subject = [h['value'] for h in headers if h['name'] == 'Subject'][0]
-        thread_id = msg['threadId']
-        body = get_email_body(msg['payload'])
-        meeting_details = extract_meeting_details(body)
-        initial_classification = classify_email_intent(body)
-        quotation_data = extract_quotation_data(body, initial_classification)
-        if initial_classification not in ["New Business Connection", "Unknown"]:
-            quotation_data = calculate_unit_price_if_missing(quotation_data)
-            quotation_data = calculate_total_cost_if_missing(quotation_data)
-        final_classification = get_final_classification(quotation_data, initial_classification)
-        name = sender.split("<")[0].strip() if "<" in sender else sender
-        email_address = sender.split("<")[1][:-1] if "<" in sender else sender
-        reply_body = get_reply_body(
-            final_classification,
-            quotation_data,
-            quotation_data.get("sender_name"),
-            meeting_details,
-            None
-        )
-        processed_emails.append({
-            "email_address": email_address,
-            "subject": subject,
-            "final_classification": final_classification,
-            "quotation_data": quotation_data,
-            "meeting_details": meeting_details,
-            "meeting_result": None,
-            "reply_body": reply_body,
-            "thread_id": thread_id
-        })
+    live_table = st.empty()
+    def on_progress(completed, total):
+        progress_bar.progress(completed / total)
+        status_text.text(f'Processed {completed} of {total} emails...' if completed else f'Fetching {total} emails...')
+    def notify(level, message):
+        (st.warning if level == "warning" else st.info)(message)
+    emails = []
+    rows = []
+    for email_data in iter_ingest_emails(gmail_service, num_emails, max_workers, incremental, on_progress, notify):
+        emails.append(email_data)
+        rows.append(live_preview_row(email_data))
+        # Each row is already in the store, so a rerun mid-batch reloads everything finished so far.
+        live_table.dataframe(pd.DataFrame(rows), use_container_width=True, hide_index=True)
     progress_bar.progress(1.0)
     status_text.text('Processing complete!')
-    return processed_emails
+    return emails
+def run_worker(interval=WORKER_INTERVAL_SECONDS, batch=WORKER_BATCH_SIZE, max_workers=MAX_CONCURRENT_EMAILS,
+               once=False):
+    """Headless ingestion loop for `python app.py worker`: sync the inbox into the store every interval seconds."""
+    refresh_token = load_refresh_token()
+    if not refresh_token:
+        raise SystemExit("No refresh token found; set REFRESH_TOKEN in secrets or authorize once in the UI "
+                         "and save refresh_token.json.")
+    gmail_service, _ = google_services(refresh_token)
+    worker_id = f"{os.uname().nodename}:{os.getpid()}"
+    started_at = time.time()
+    record_worker_heartbeat(worker_id, started_at)
+    logger.info(f"Worker {worker_id} started; syncing up to {batch} emails every {interval}s")
+    while True:
+        try:
+            emails = ingest_emails(gmail_service, batch, max_workers, incremental=True)
+            record_worker_heartbeat(worker_id, started_at, processed=len(emails))
+            logger.info(f"Processed {len(emails)} new emails")
+        except Exception as e:
+            logger.error(f"Worker run failed: {e}")
+            record_worker_heartbeat(worker_id, started_at, processed=0, error=str(e))
+        if once:
+            return
+        time.sleep(interval)
 def main():
     st.set_page_config(page_title="Supplier Quotation Processor", layout="wide")
     st.title("Supplier Quotation Processing System")
@@ -1112,6 +3159,7 @@ def main():
                         st.session_state.gmail_service = gmail_service
                         st.session_state.calendar_service = calendar_service
                         st.session_state.authenticated = True
+                        st.session_state.processed_emails_loaded = False
                         st.sidebar.success("Authentication successful!")
                         st.rerun()
                     else:
@@ -1124,33 +3172,194 @@ def main():
             st.session_state.authenticated = False
             st.session_state.gmail_service = None
             st.session_state.calendar_service = None
-            st.session_state.processed_emails = []
+            st.session_state.account = None
+            set_processed_emails([])
+            st.session_state.processed_emails_loaded = False
+            st.session_state.store_revision = None
+            st.session_state.reply_drafts = {}
             st.session_state.chat_messages = []
             st.rerun()
+    st.sidebar.header("LLM Usage")
+    llm_cache_settings["enabled"] = st.sidebar.checkbox("Use cached LLM responses", value=llm_cache_settings["enabled"])
+    stats = llm_cache_stats()
+    st.sidebar.caption(f"Cache hits: {stats['hits']} | misses: {stats['misses']} | bypassed: {stats['bypassed']}")
+    metrics = extraction_metrics()
+    if metrics["fields_total"]:
+        st.sidebar.caption(
+            f"Rule-based extraction resolved {metrics['fields_local']} of {metrics['fields_total']} fields "
+            f"({metrics['fields_local'] / metrics['fields_total']:.0%}) locally; "
+            f"{metrics['emails_without_llm']} of {metrics['emails']} emails needed no extraction call.")
+        with st.sidebar.expander("Local resolution by field"):
+            for key, (local, total) in metrics["per_field"].items():
+                st.write(f"{key}: {local}/{total} ({local / total:.0%})")
+    (emails_measured, raw_tokens, body_tokens), token_rows = body_token_report(
+        session_account() if st.session_state.authenticated else None)
+    if emails_measured:
+        st.sidebar.caption(f"Body preprocessing saved ~{raw_tokens - body_tokens:,} of {raw_tokens:,} body tokens "
+                           f"across {emails_measured} emails, before each prompt that includes them.")
+        with st.sidebar.expander("Tokens saved per email"):
+            import pandas as pd
+            st.dataframe(pd.DataFrame(
+                [(subject, sender, raw, cleaned, raw - cleaned) for subject, sender, raw, cleaned in token_rows],
+                columns=["Subject", "Email", "Raw", "Cleaned", "Saved"]), hide_index=True)
+    limiter = llm_rate_limiter()
+    st.sidebar.caption(f"OpenAI concurrency {int(limiter.concurrency)}/{limiter.max_concurrency}, "
+                       f"{limiter.in_flight} in flight, {limiter.rate_limited} rate-limit responses.")
+    if st.sidebar.button("Clear LLM cache"):
+        clear_llm_cache()
+        st.sidebar.success("LLM cache cleared.")
+    st.sidebar.header("Intent Classifier")
+    intent_model = current_intent_model()
+    if intent_model:
+        st.sidebar.caption(f"Local model trained on {intent_model['examples']} emails; "
+                           f"LLM fallback below {LOCAL_CLASSIFIER_THRESHOLD:.0%} confidence.")
+    if st.sidebar.button("Retrain intent classifier"):
+        try:
+            st.sidebar.code(format_intent_report(retrain_intent_model()))
+        except ValueError as e:
+            st.sidebar.warning(str(e))
+    elif intent_model and intent_model.get("report"):
+        with st.sidebar.expander("Accuracy against LLM labels"):
+            st.code(format_intent_report(intent_model["report"]))
+    st.sidebar.header("Background Worker")
+    worker = latest_worker_status()
+    if worker and time.time() - (worker["last_run_at"] or worker["started_at"]) < WORKER_STALE_SECONDS:
+        st.sidebar.caption(f"Worker {worker['worker_id']} last synced "
+                           f"{datetime.fromtimestamp(worker['last_run_at']).strftime('%H:%M:%S')}: "
+                           f"{worker['last_processed'] or 0} new, {worker['total_processed']} since start.")
+        if worker["last_error"]:
+            st.sidebar.warning(f"Last worker run failed: {worker['last_error']}")
+    else:
+        st.sidebar.caption("No worker running; start one with `python app.py worker` "
+                           "or process emails manually below.")
+    # The worker and other sessions write to the same store; pick up their rows on the next rerun.
+    if st.session_state.authenticated and (not st.session_state.processed_emails_loaded
+                                           or email_store_revision(session_account()) != st.session_state.store_revision):
+        reload_processed_emails()
     prompt = st.sidebar.chat_input("Ask about supplier quotes or email details...")
     chatbot_response(prompt)
     if not st.session_state.authenticated:
         st.warning("Please authenticate with Google to continue.")
         return
     st.header("Process Emails")
-    col1, col2 = st.columns([2, 1])
+    col1, col2, col3 = st.columns([2, 1, 1])
     with col1:
         num_emails = st.slider("Number of emails to process", 1, 20, 5)
     with col2:
+        max_workers = st.number_input("Concurrent emails", 1, 32, MAX_CONCURRENT_EMAILS)
+    with col3:
         st.write("")
         process_button = st.button("Process Latest Emails", type="primary")
+    incremental = st.checkbox("Only process mail received since the last sync", value=True)
+    with st.expander("Backfill older mail"):
+        today = datetime.now().date()
+        date_range = st.date_input("Received between", (today - timedelta(days=90), today))
+        label = st.text_input("Label", value="INBOX")
+        restart = st.checkbox("Restart from the first page instead of resuming")
+        after, before = (tuple(date_range) + (None, None))[:2] if isinstance(date_range, tuple) else (date_range, None)
+        # Gmail's before: is exclusive; include the whole last day.
+        before = before + timedelta(days=1) if before else None
+        job = load_backfill_job(backfill_job_id(session_account(), backfill_query(after, before, label)))
+        if job:
+            st.caption(f"Checkpoint: {job['processed']} emails stored, {job['status']}.")
+        if st.button("Run backfill"):
+            progress_bar = st.progress(0)
+            status_text = st.empty()
+            def on_progress(done, estimate):
+                progress_bar.progress(min(done / estimate, 1.0) if estimate else 0)
+                status_text.text(f"Scanned {done} of about {estimate} messages...")
+            def notify(level, message):
+                (st.warning if level == "warning" else st.info)(message)
+            try:
+                count = sum(1 for _ in iter_backfill(st.session_state.gmail_service, after, before, label,
+                                                     int(max_workers), on_progress, notify, restart))
+                st.success(f"Backfill stored {count} new emails.")
+                reload_processed_emails()
+            except Exception as e:
+                st.error(f"Error during backfill: {str(e)}")
     if process_button:
         with st.spinner("Processing emails..."):
             try:
-                st.session_state.processed_emails = process_emails(
+                new_emails = process_emails(
                     st.session_state.gmail_service,
                     st.session_state.calendar_service,
-                    num_emails
+                    num_emails,
+                    int(max_workers),
+                    incremental
                 )
-                st.success(f"Successfully processed {len(st.session_state.processed_emails)} emails!")
+                reload_processed_emails()
+                st.success(f"Successfully processed {len(new_emails)} emails!")
             except Exception as e:
                 st.error(f"Error processing emails: {str(e)}")
     if st.session_state.processed_emails:
         display_classification_tables(st.session_state.processed_emails)
+    display_failed_emails()
+    display_unfinished_replies()
+def measure_import_seconds(modules):
+    """Wall time to import modules in a fresh interpreter, so nothing is already in sys.modules."""
+    import subprocess
+    code = "import time\nstart = time.perf_counter()\n" + "".join(f"import {module}\n" for module in modules)
+    code += "print(time.perf_counter() - start)"
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True)
+    return float(result.stdout.strip())
+def startup_report(repeats=3):
+    lines = []
+    for module in STARTUP_EAGER_MODULES + STARTUP_DEFERRED_MODULES:
+        seconds = min(measure_import_seconds([module]) for _ in range(repeats))
+        lines.append(f"{module:<34}{seconds * 1000:>8.0f} ms{'  (deferred)' if module in STARTUP_DEFERRED_MODULES else ''}")
+    before = min(measure_import_seconds(STARTUP_EAGER_MODULES + STARTUP_DEFERRED_MODULES) for _ in range(repeats))
+    after = min(measure_import_seconds(STARTUP_EAGER_MODULES) for _ in range(repeats))
+    lines.append(f"{'imports before first render, eager':<34}{before * 1000:>8.0f} ms")
+    lines.append(f"{'imports before first render, now':<34}{after * 1000:>8.0f} ms")
+    return "\n".join(lines)
 if __name__ == '__main__':
-    main()
+    if sys.argv[1:2] == ['retrain-intent-model']:
+        print(format_intent_report(retrain_intent_model()))
+    elif sys.argv[1:2] == ['release-reply-claims']:
+        for row in stale_reply_claims():
+            print(f"{datetime.fromtimestamp(row['claimed_at']).strftime('%Y-%m-%d %H:%M')}  "
+                  f"{row['email_address']}: {row['subject']}")
+        print(f"Released {release_stale_reply_claims()} unfinished reply claims.")
+    elif sys.argv[1:2] == ['benchmark-mime']:
+        if len(sys.argv) < 3:
+            sys.exit("usage: python app.py benchmark-mime <directory of .eml/.json samples>")
+        print(benchmark_mime(sys.argv[2]))
+    elif sys.argv[1:2] == ['startup-report']:
+        print(startup_report())
+    elif sys.argv[1:2] == ['backfill']:
+        import argparse
+        parser = argparse.ArgumentParser(prog="app.py backfill", description="Process older mail page by page.")
+        parser.add_argument("--after", type=lambda value: datetime.strptime(value, "%Y-%m-%d"), help="YYYY-MM-DD")
+        parser.add_argument("--before", type=lambda value: datetime.strptime(value, "%Y-%m-%d"),
+                            help="YYYY-MM-DD (exclusive)")
+        parser.add_argument("--label", default="INBOX")
+        parser.add_argument("--workers", type=int, default=MAX_CONCURRENT_EMAILS, help="emails processed concurrently")
+        parser.add_argument("--restart", action="store_true", help="ignore the checkpoint and start from page one")
+        args = parser.parse_args(sys.argv[2:])
+        refresh_token = load_refresh_token()
+        if not refresh_token:
+            sys.exit("No refresh token found; set REFRESH_TOKEN in secrets or save refresh_token.json.")
+        gmail_service, _ = google_services(refresh_token)
+        count = 0
+        try:
+            for email_data in iter_backfill(gmail_service, args.after, args.before, args.label, args.workers,
+                                            restart=args.restart):
+                count += 1
+                if count % 100 == 0:
+                    logger.info(f"Backfill stored {count} emails")
+        except KeyboardInterrupt:
+            print(f"Interrupted after {count} emails; run the same command again to resume.")
+    elif sys.argv[1:2] == ['worker']:
+        import argparse
+        parser = argparse.ArgumentParser(prog="app.py worker", description="Sync the inbox into the email store.")
+        parser.add_argument("--interval", type=int, default=WORKER_INTERVAL_SECONDS, help="seconds between syncs")
+        parser.add_argument("--batch", type=int, default=WORKER_BATCH_SIZE, help="max emails per sync")
+        parser.add_argument("--workers", type=int, default=MAX_CONCURRENT_EMAILS, help="emails processed concurrently")
+        parser.add_argument("--once", action="store_true", help="run a single sync and exit")
+        args = parser.parse_args(sys.argv[2:])
+        try:
+            run_worker(args.interval, args.batch, args.workers, args.once)
+        except KeyboardInterrupt:
+            pass
+    else:
+        main()
@@ -0,0 +1,8 @@
+import os
+import sys
+
+# app.py reads its OpenAI key and store paths at import time; tests never reach the API or the real stores.
+os.environ.setdefault("OPENAI_API_KEY", "test-key")
+os.environ.setdefault("EMAIL_STORE_PATH", os.path.join(os.path.dirname(__file__), "processed_emails.test.sqlite3"))
+os.environ.setdefault("LLM_CACHE_PATH", os.path.join(os.path.dirname(__file__), "llm_cache.test.sqlite3"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
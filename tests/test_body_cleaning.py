@@ -0,0 +1,26 @@
+import pytest
+
+from app import clean_email_body
+
+
+@pytest.mark.parametrize("body, dropped", [
+    ("Price is Rs. 120 per piece.\n\nOn Mon, 4 Aug 2025 at 10:00, Buyer <buyer@example.com> wrote:\n> Please quote",
+     "Please quote"),
+    ("Attached our offer.\n\nFrom: Buyer <buyer@example.com>\nSent: Monday, August 4, 2025 10:00 AM\nSubject: RFQ\n\n"
+     "Please quote 500 gaskets", "Please quote 500 gaskets"),
+])
+def test_quoted_history_is_dropped(body, dropped):
+    cleaned = clean_email_body(body)
+    assert body.split("\n")[0] in cleaned
+    assert dropped not in cleaned
+
+
+@pytest.mark.parametrize("body, kept", [
+    ("FYI, see the quote below.\n\n---------- Forwarded message ---------\nFrom: Sales <sales@example.com>\n"
+     "Date: Mon, 4 Aug 2025 at 10:00\nSubject: Quotation\n\nUnit price: $4.50, lead time 10 days",
+     "Unit price: $4.50, lead time 10 days"),
+    ("Forwarding this.\n\nBegin forwarded message:\n\nFrom: Sales <sales@example.com>\nDate: 4 August 2025\n\n"
+     "Quantity 1,000 pcs at Rs. 12 each", "Quantity 1,000 pcs at Rs. 12 each"),
+])
+def test_forwarded_message_is_kept(body, kept):
+    assert kept in clean_email_body(body)
@@ -0,0 +1,45 @@
+from datetime import datetime
+
+import pytest
+import pytz
+
+from app import resolve_datetime_locally
+
+# A Monday; every phrase below resolves relative to it.
+NOW = datetime.fromisoformat("2025-08-04T09:00:00+05:30").astimezone(pytz.timezone('Asia/Kolkata'))
+
+
+@pytest.mark.parametrize("phrase, reference, expected", [
+    ("6th at 4PM", None, "2025-08-06T16:00:00+05:30"),
+    ("on the 2nd at 11 am", None, "2025-09-02T11:00:00+05:30"),
+    ("Monday morning", None, "2025-08-11T10:00:00+05:30"),
+    ("next Wednesday at 3:30 pm", None, "2025-08-06T15:30:00+05:30"),
+    ("tomorrow at 2:30", None, "2025-08-05T14:30:00+05:30"),
+    ("day after tomorrow 10am", None, "2025-08-06T10:00:00+05:30"),
+    ("today at noon", None, "2025-08-04T12:00:00+05:30"),
+    ("same day at 2:30", "2025-08-12T11:00:00+05:30", "2025-08-12T14:30:00+05:30"),
+    ("push it to 4 pm same day", "2025-08-12T11:00:00+05:30", "2025-08-12T16:00:00+05:30"),
+    ("same time on Friday", "2025-08-05T11:15:00+05:30", "2025-08-08T11:15:00+05:30"),
+    ("12th August at 11:00 AM", None, "2025-08-12T11:00:00+05:30"),
+    ("Aug 1 at 10am", None, "2026-08-01T10:00:00+05:30"),
+    ("31st at 9:15am", None, "2025-08-31T09:15:00+05:30"),
+    ("in 3 days at 4pm", None, "2025-08-07T16:00:00+05:30"),
+    ("2025-09-08T16:30:00+05:30", None, "2025-09-08T16:30:00+05:30"),
+    ("Thursday 16:00", None, "2025-08-07T16:00:00+05:30"),
+])
+def test_resolves_phrase(phrase, reference, expected):
+    resolved, _ = resolve_datetime_locally(phrase, NOW, reference)
+    assert resolved.isoformat() == expected
+
+
+@pytest.mark.parametrize("phrase", [
+    "same day at 3pm",
+    "next week",
+    "Monday or Tuesday at 4pm",
+    "at 4pm",
+    "bring a flyer",
+    "6th",
+])
+def test_leaves_unresolvable_phrase_to_the_llm(phrase):
+    resolved, _ = resolve_datetime_locally(phrase, NOW)
+    assert resolved is None
@@ -0,0 +1,36 @@
+import pytest
+
+from app import RULE_CONFIDENCE_THRESHOLD, rule_extract_fields
+
+
+@pytest.mark.parametrize("body, expected", [
+    ("Regards,\nRavi Kumar\nMob: +91 98765 43210", "+91 98765 43210"),
+    ("Regards,\nRavi Kumar\nPh: 98765-43210", "98765-43210"),
+    ("Regards,\nAnita\nTel. 022-2345-6789", "022-2345-6789"),
+])
+def test_labelled_phone_numbers_are_trusted(body, expected):
+    value, confidence = rule_extract_fields(body)["contact_number"]
+    assert value == expected
+    assert confidence >= RULE_CONFIDENCE_THRESHOLD
+
+
+@pytest.mark.parametrize("body", [
+    "Can we meet on 2025-08-12 11:00?",
+    "Delivery by 12-08-2025 10 am",
+    "Ref: 2025-08-0412",
+])
+def test_dates_are_not_phone_numbers(body):
+    assert "contact_number" not in rule_extract_fields(body)
+
+
+def test_unlabelled_number_is_left_to_the_llm():
+    value, confidence = rule_extract_fields("PO 4500-123-456 received")["contact_number"]
+    assert value == "4500-123-456"
+    assert confidence < RULE_CONFIDENCE_THRESHOLD
+
+
+def test_unit_price_quantity_and_lead_time():
+    fields = rule_extract_fields("Please find our offer: 500 pcs at Rs. 120 per piece. Lead time: 2 weeks.")
+    assert fields["unit_price"] == ("₹120", 0.9)
+    assert fields["quantity"] == ("500 pcs", 0.9)
+    assert fields["lead_time"] == ("14 days", 0.9)
@@ -0,0 +1,29 @@
+from app import answer_structured_query
+
+
+def quote(product, unit_price, classification="Quotation Received", **fields):
+    quotation_data = {"product": product, "quantity": "100 pcs", "unit_price": unit_price, "total_cost": "Not present",
+                      "lead_time": "10 days", "company_name": f"{product} Co", "sender_name": "Not present"}
+    quotation_data.update(fields)
+    return {"email_address": f"{product.lower()}@example.com", "subject": "Quotation",
+            "final_classification": classification, "quotation_data": quotation_data}
+
+
+def test_price_limit_without_currency_is_answered_per_currency():
+    answer = answer_structured_query("quotes under 200", [quote("Gasket", "₹150"), quote("Valve", "$120"),
+                                                        quote("Flange", "₹900")])
+    assert "by currency" in answer
+    assert answer.index("In INR") < answer.index("Gasket") < answer.index("In USD") < answer.index("Valve")
+    assert "Flange" not in answer
+
+
+def test_price_limit_with_currency_keeps_only_that_currency():
+    answer = answer_structured_query("quotes under $200", [quote("Gasket", "₹150"), quote("Valve", "$120")])
+    assert "Valve" in answer
+    assert "Gasket" not in answer
+
+
+def test_partial_quote_missing_fields_match_the_table():
+    answer = answer_structured_query("partial quotes", [
+        quote("Gasket", "Not present", classification="Quotation Partially Received")])
+    assert answer.endswith("missing unit price")